@@ -1,10 +1,14 @@
 import logging
 import pickle as pkl
 from utility.dataloader import Data
+from utility.sampler import SamplePrefetcher
+from utility.partition import partition_batches
+from utility.optimizer import LazyAdam
 from utility.return_meta import return_meta
 from utility.model_logging_utils import get_next_log_filename, configure_logging
 import time
 import torch
+import numpy as np
 import torch.optim as optim
 import os
 import utility.parser
@@ -17,6 +21,18 @@ import warnings
 warnings.filterwarnings('ignore')
 
 
+def partition_steps(lightgcn, groups, batch_size, device, intra_only=False):
+    """
+    每组分区只构造一次步邻接, 组内样本再按 batch_size 切分为若干步.
+    正样本物品可能不在所选分区内, 除非只保留分区内的样本, 步邻接还要包含它们的完整邻居
+    """
+    for parts, triples in groups:
+        positives = None if intra_only else torch.from_numpy(np.unique(triples[:, 1]) + lightgcn.n_users)
+        lightgcn.use_partitions(parts, positives)
+        yield from utility.batch_test.mini_batch(*torch.from_numpy(triples).to(device).unbind(1),
+                                                 batch_size=batch_size)
+
+
 def main():
     utility.batch_test.set_seed(2023)
     # step 1: Check device
@@ -34,6 +50,8 @@ def main():
 
     g = g.to(device)
     dataset = Data(args.data_path + args.dataset)
+    # 后台线程预取下一个 epoch 的训练样本
+    sampler = SamplePrefetcher(dataset, args.sample_mode, args.num_workers, args.seed)
     print("Data loaded.")
     meta_paths, user_key, item_key, ui_relation = return_meta(args.dataset)
     args.meta_path_patterns = meta_paths
@@ -43,7 +61,13 @@ def main():
     # step 3: Create model and training components
     model = HDCL(g, args)
     model = model.to(device)
-    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    if args.lazy_adam:
+        # 嵌入表只更新本步梯度非零的行, 其余稠密参数仍为普通 Adam
+        tables = {id(param) for param in model.embedding_tables()}
+        optimizer = LazyAdam([{'params': [param for param in model.parameters() if id(param) not in tables]},
+                              {'params': model.embedding_tables(), 'lazy': True}], lr=args.lr)
+    else:
+        optimizer = optim.Adam(model.parameters(), lr=args.lr)
     print("Model created.")
 
 
@@ -91,22 +115,36 @@ def main():
                 )
 
         model.train()
-        sample_data = dataset.sample_data_to_train_all()
-        users = torch.Tensor(sample_data[:, 0]).long()
-        pos_items = torch.Tensor(sample_data[:, 1]).long()
-        neg_items = torch.Tensor(sample_data[:, 2]).long()
+        if args.history_interval < 0:
+            model.reset_history()
+        sample_data = next(sampler)
+        users = torch.from_numpy(sample_data[:, 0])
+        pos_items = torch.from_numpy(sample_data[:, 1])
+        neg_items = torch.from_numpy(sample_data[:, 2])
 
         users = users.to(device)
         pos_items = pos_items.to(device)
         neg_items = neg_items.to(device)
 
-        users, pos_items, neg_items = utility.batch_test.shuffle(users, pos_items, neg_items)
         num_batch = len(users) // args.batch_size + 1
         average_loss = 0.
         average_reg_loss = 0.
 
-        for batch_i, (batch_users, batch_positive, batch_negative) in enumerate(
-                utility.batch_test.mini_batch(users, pos_items, neg_items, batch_size=args.batch_size)):
+        if model.LightGCN.num_partitions > 0:
+            # 分区训练: 每组分区只取其中用户的样本, 负样本在同一组分区的物品中重新抽取, 再按 batch_size 分步
+            batches = partition_steps(model.LightGCN,
+                                      partition_batches(sample_data, model.LightGCN.node_parts,
+                                                        model.LightGCN.n_users, args.partitions_per_batch,
+                                                        dataset.sampler,
+                                                        intra_only=args.partition_positives == 'intra'),
+                                      args.batch_size, device, intra_only=args.partition_positives == 'intra')
+        else:
+            batches = utility.batch_test.mini_batch(users, pos_items, neg_items, batch_size=args.batch_size)
+
+        steps = 0
+        for batch_i, batch in enumerate(batches):
+            steps += 1
+            batch_users, batch_positive, batch_negative = batch
             batch_mf_loss, batch_emb_loss = model.bpr_loss(batch_users, batch_positive, batch_negative)
             # batch_loss= model.bpr_loss(batch_users, batch_positive, batch_negative)
             batch_emb_loss = eval(args.regs)[0] * batch_emb_loss
@@ -114,15 +152,21 @@ def main():
             optimizer.zero_grad()
             batch_loss.backward()
             optimizer.step()
+            model.maybe_recluster(optimizer)
             average_loss += batch_mf_loss.item()
             average_reg_loss += batch_emb_loss.item()
 
+        model.LightGCN.use_partitions(None)
+        if model.LightGCN.num_partitions > 0:
+            num_batch = max(steps, 1)  # 空的分区组不产生训练步
         average_loss = average_loss / num_batch
         average_reg_loss = average_reg_loss / num_batch
         time_elapsed = time.time() - since
         print("\t Epoch: %4d| train time: %.3f | train_loss:%.4f + %.4f" % (
             epoch + 1, time_elapsed, average_loss, average_reg_loss))
 
+    sampler.close()
+    model.stop_reclustering()
     print("best epoch:", best_report_epoch)
     print("best recall:", best_report_recall)
     print("best ndcg:", best_report_ndcg)
@@ -1,12 +1,72 @@
+import os
 import dgl
+import math
 import torch
 import numpy as np
-import torch_sparse
 import torch.nn as nn
 import scipy.sparse as sp
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from concurrent.futures import ThreadPoolExecutor
+from utility.similarity import topk_similarity
+from utility.metapath import load_metapath_adjacencies, metapath_name
+from utility.partition import label_propagation_partition
 from dgl.nn.pytorch import GATConv, HGTConv, GraphConv
-from sklearn.cluster import KMeans
+
+
+def select_rows(adj, rows):
+    """取 CSR 张量中 rows 对应的行 (按 rows 的顺序), 返回 [len(rows), n_cols] 的 CSR 张量"""
+    crow = adj.crow_indices().long()
+    start = crow[rows]
+    degree = crow[rows + 1] - start
+    new_crow = torch.cat([degree.new_zeros(1), torch.cumsum(degree, 0)])
+    edges = start.repeat_interleave(degree) + torch.arange(int(new_crow[-1]), device=crow.device) - \
+        new_crow[:-1].repeat_interleave(degree)
+    return torch.sparse_csr_tensor(new_crow.to(adj.col_indices().dtype), adj.col_indices()[edges], adj.values()[edges],
+                                   size=(len(rows), adj.shape[1]), device=adj.device)
+
+
+class ChunkedLogSumExp(torch.autograd.Function):
+    """
+    logsumexp(anchor @ negatives.T / temperature, dim=1), 按 anchor 分块计算.
+    反向时逐块重算得分矩阵, 不保存完整的 (N, M) 得分, 峰值显存为 O(chunk_size * M).
+    """
+
+    @staticmethod
+    def forward(ctx, anchor, negatives, temperature, chunk_size):
+        lse = torch.cat([torch.logsumexp(torch.mm(anchor[start:start + chunk_size], negatives.t()) / temperature, dim=1)
+                         for start in range(0, len(anchor), chunk_size)])
+        ctx.save_for_backward(anchor, negatives, lse)
+        ctx.temperature = temperature
+        ctx.chunk_size = chunk_size
+        return lse
+
+    @staticmethod
+    def backward(ctx, grad_lse):
+        anchor, negatives, lse = ctx.saved_tensors
+        temperature, chunk_size = ctx.temperature, ctx.chunk_size
+        grad_anchor = torch.empty_like(anchor) if ctx.needs_input_grad[0] else None
+        grad_negatives = torch.zeros_like(negatives) if ctx.needs_input_grad[1] else None
+        for start in range(0, len(anchor), chunk_size):
+            end = min(start + chunk_size, len(anchor))
+            anchor_chunk = anchor[start:end]
+            # d lse / d score = softmax(score), 再乘上游梯度与 1 / temperature
+            prob = torch.exp(torch.mm(anchor_chunk, negatives.t()) / temperature - lse[start:end].unsqueeze(1))
+            prob = prob * (grad_lse[start:end] / temperature).unsqueeze(1)
+            if grad_anchor is not None:
+                grad_anchor[start:end] = torch.mm(prob, negatives)
+            if grad_negatives is not None:
+                grad_negatives += torch.mm(prob.t(), anchor_chunk)
+        return grad_anchor, grad_negatives, None, None
+
+
+def info_nce(anchor, positive, negatives, temperature, chunk_size=1024):
+    """
+    -mean(log(exp(<a, p> / t) / sum_n exp(<a, n> / t))), 以稳定的 log-sum-exp 分块计算,
+    值和梯度与直接构造完整得分矩阵一致, 低温时不会溢出.
+    """
+    pos_score = torch.sum(anchor * positive, dim=1) / temperature
+    return torch.mean(ChunkedLogSumExp.apply(anchor, negatives, temperature, chunk_size) - pos_score)
 
 
 # Semantic attention in the metapath-based aggregation (the same as that in the HAN)
@@ -20,15 +80,22 @@ class SemanticAttention(nn.Module):
             nn.Linear(hidden_size, 1, bias=False)
         )
 
-    def forward(self, z):
+    def scores(self, z):
+        return self.project(z).mean(0)  # (M, 1)
+
+    def forward(self, z, population_scores=None):
         '''
         Shape of z: (N, M , D*K)
         N: number of nodes
         M: number of metapath patterns
         D: hidden_size
         K: number of heads
+        population_scores: (M, 1) scores averaged over all nodes; when z only holds a sample of the nodes
+            they give the value of the scores, the gradient still flows through the mean over z
         '''
-        w = self.project(z).mean(0)  # (M, 1)
+        w = self.scores(z)  # (M, 1)
+        if population_scores is not None:
+            w = population_scores + (w - w.detach())
         beta = torch.softmax(w, dim=0)  # (M, 1)
         beta = beta.expand((z.shape[0],) + beta.shape)  # (N, M, 1)
         return (beta * z).sum(1)  # (N, D * K)
@@ -36,7 +103,9 @@ class SemanticAttention(nn.Module):
 
 # Metapath-based aggregation (the same as the HANLayer)
 class HANLayer(nn.Module):
-    def __init__(self, meta_path_patterns, in_size, out_size, layer_num_heads, dropout):
+    def __init__(self, meta_path_patterns, in_size, out_size, layer_num_heads, dropout, fused=True,
+                 cache_dir=None, n_threads=1, topk=0, topk_score='count', fanout=0, checkpointing=False,
+                 topk_seed=0):
         super(HANLayer, self).__init__()
 
         # One GAT layer for each meta path based adjacency matrix
@@ -50,29 +119,268 @@ class HANLayer(nn.Module):
         self.semantic_attention = SemanticAttention(in_size=out_size * layer_num_heads)
         self.meta_path_patterns = list(tuple(meta_path_pattern) for meta_path_pattern in meta_path_patterns)
 
+        self.fused = fused  # 所有元路径的归一化邻接纵向堆叠, 一次 SpMM 完成聚合
+        self.cache_dir = cache_dir  # 元路径可达图的磁盘缓存目录, None 表示不缓存
+        self.n_threads = n_threads  # 计算元路径稀疏矩阵乘积的线程数
+        self.topk = topk  # 每个节点保留的元路径邻居数, int 或 {'bc-cb': k} 形式按元路径指定, 0 不截断
+        self.topk_score = topk_score  # top-k 排序依据: 'count' 路径数, 'random_walk' 随机游走概率
+        self.topk_seed = topk_seed  # top-k 截断时得分相同的邻居随机取舍的种子
+        self.fanout = fanout  # 采样训练时每个节点在各元路径上采样的邻居数, int 或按元路径的 dict, 0 取全部邻居
+        self.checkpointing = checkpointing  # 反向时重算每条元路径的卷积与语义注意力, 不保存其激活
         self._cached_graph = None
+        self._cached_adj = {}  # 元路径 -> 路径计数的 scipy CSR
         self._cached_coalesced_graph = {}
-
-    def forward(self, g, h):
-        semantic_embeddings = []
+        self._stacked_adj = None
+        self._in_neighbors = None  # 元路径 -> 设备上的 (indptr, indices, 出度), 行为目标节点
+        self._self_weight = None
+        self._history = {}  # 历史嵌入: slot -> 去掉自环项的聚合结果 (N, M, D * K)
+        self._population_scores = None  # 采样训练时每层在全体节点上的语义注意力得分 [(M, 1)], 定期刷新
+
+    def _stack_normalized_adj(self, device):
+        r"""Stacks the normalized adjacency of every metapath graph into one [M * N, N] CSR tensor.
+
+        Block ``i`` holds ``D_in^-1/2 A_i^T D_out^-1/2`` of the i-th metapath graph, with degrees clamped to 1
+        as ``GraphConv(norm='both', allow_zero_in_degree=True)`` does, so ``stacked @ h`` viewed as [M, N, D]
+        equals the per-metapath GraphConv outputs.
+        """
+        blocks = []
+        for meta_path_pattern in self.meta_path_patterns:
+            adj = (self._cached_adj[meta_path_pattern] != 0).astype(np.float32)  # [src, dst]
+            out_degree = np.maximum(np.asarray(adj.sum(axis=1)).ravel(), 1.)
+            in_degree = np.maximum(np.asarray(adj.sum(axis=0)).ravel(), 1.)
+            block = adj.T.tocsr()  # [dst, src]
+            block.sort_indices()
+            rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+            block.data = (np.power(in_degree[rows], -0.5) * np.power(out_degree[block.indices], -0.5)).astype(np.float32)
+            blocks.append(block)
+        stacked = sp.vstack(blocks, format='csr')
+        return torch.sparse_csr_tensor(torch.from_numpy(stacked.indptr.astype(np.int32)),
+                                       torch.from_numpy(stacked.indices.astype(np.int32)),
+                                       torch.from_numpy(stacked.data.astype(np.float32)),
+                                       size=stacked.shape, device=device)
+
+    def _coalesced_graph(self, meta_path_pattern):
+        """由路径计数矩阵按需构造 DGL 同构图, 仅非融合路径使用"""
+        if meta_path_pattern not in self._cached_coalesced_graph:
+            adj = self._cached_adj[meta_path_pattern]
+            src, dst = adj.nonzero()
+            self._cached_coalesced_graph[meta_path_pattern] = dgl.graph(
+                (torch.from_numpy(src), torch.from_numpy(dst)), num_nodes=adj.shape[0],
+                device=self._cached_graph.device)
+        return self._cached_coalesced_graph[meta_path_pattern]
+
+    def _prepare(self, g):
         # obtain metapath reachable graph
         if self._cached_graph is None or self._cached_graph is not g:
             self._cached_graph = g
             self._cached_coalesced_graph.clear()
+            self._stacked_adj = None
+            self._in_neighbors = None
+            self._self_weight = None
+            self._history.clear()
+            self._population_scores = None
+            self._cached_adj = load_metapath_adjacencies(g, self.meta_path_patterns, self.cache_dir, self.n_threads,
+                                                         self.topk, self.topk_score, self.topk_seed)
+
+    def _sample_in_neighbors(self, meta_path_pattern, seeds):
+        """
+        为 seeds 在一条元路径上采样入邻居, 返回 (seed 下标, 邻居全局 id, 边权).
+        度数不超过 fanout 的节点取全部邻居; 其余有放回地抽 fanout 次后去重, 故最多 fanout 个邻居.
+        边权按全图度数做 'both' 归一化并乘以 度数 / 采样数, fanout 为 0 时与全图聚合完全一致.
+        """
+        indptr, indices, out_degree = self._in_neighbors[meta_path_pattern]
+        fanout = self.fanout.get(metapath_name(meta_path_pattern), 0) if isinstance(self.fanout, dict) \
+            else self.fanout
+        start = indptr[seeds]
+        degree = indptr[seeds + 1] - start
+        rows = torch.arange(len(seeds), device=seeds.device)
+        full = degree <= fanout if fanout > 0 else torch.ones_like(degree, dtype=torch.bool)
+
+        full_rows = rows[full].repeat_interleave(degree[full])
+        full_offsets = torch.arange(len(full_rows), device=seeds.device) - \
+            (torch.cumsum(degree[full], 0) - degree[full]).repeat_interleave(degree[full])
+        sampled_rows = rows[~full].repeat_interleave(fanout) if fanout > 0 else rows[:0]
+        sampled_offsets = (torch.rand(len(sampled_rows), device=seeds.device) * degree[sampled_rows]).long()
+        if len(sampled_rows) > 0:
+            # 同一节点重复抽到的邻居只保留一次
+            stride = int(degree.max()) + 1
+            keys = torch.unique(sampled_rows * stride + sampled_offsets)
+            sampled_rows, sampled_offsets = keys // stride, keys % stride
+
+        dst = torch.cat([full_rows, sampled_rows])
+        src = indices[start[dst] + torch.cat([full_offsets, sampled_offsets])]
+        num_sampled = torch.bincount(dst, minlength=len(seeds)).clamp(min=1)
+        in_degree = degree.clamp(min=1).float()
+        weight = in_degree[dst].pow(-0.5) * out_degree[src].pow(-0.5) * (in_degree / num_sampled)[dst]
+        return dst, src, weight
+
+    def _sample_blocks(self, seeds):
+        """
+        在所有元路径上为 seeds 采样一层邻居, 返回每条元路径的 (dst 局部下标, src 局部下标, 边权) 和 src 节点.
+        src 节点按 DGL block 的约定以 seeds 开头, 其余为新采到的邻居.
+        """
+        edges = [self._sample_in_neighbors(meta_path_pattern, seeds) for meta_path_pattern in self.meta_path_patterns]
+        candidates = torch.cat([seeds] + [src for _, src, _ in edges])
+        unique_nodes, inverse = torch.unique(candidates, return_inverse=True)
+        positions = torch.arange(len(candidates), device=candidates.device)
+        first = torch.full((len(unique_nodes),), len(candidates), dtype=torch.long, device=candidates.device)
+        first = first.scatter_reduce(0, inverse, positions, reduce='amin')
+        order = torch.argsort(first)  # seeds 各自第一次出现, 排在最前
+        rank = torch.empty_like(order)
+        rank[order] = torch.arange(len(order), device=order.device)
+        local = rank[inverse]
+        blocks, offset = [], len(seeds)
+        for dst, src, weight in edges:
+            blocks.append((dst, local[offset:offset + len(src)], weight))
+            offset += len(src)
+        return blocks, unique_nodes[order]
+
+    def _aggregate_blocks(self, blocks, x, num_dst, population_scores=None):
+        """在一层采样块上聚合, x 为 src 节点的表示 (前 num_dst 行即 dst 节点)"""
+        num_src = x.shape[0]
+        if not self.fused:
+            semantic_embeddings = []
+            for i, (dst, src, weight) in enumerate(blocks):
+                block = dgl.create_block((src, dst), num_src_nodes=num_src, num_dst_nodes=num_dst, device=x.device)
+                # GraphConv 会再按块内度数归一化, 边权预先抵消这部分, 结果与融合路径一致
+                block_in = torch.bincount(dst, minlength=num_dst).clamp(min=1).float()
+                block_out = torch.bincount(src, minlength=num_src).clamp(min=1).float()
+                edge_weight = weight * (block_in[dst] * block_out[src]).sqrt()
+                semantic_embeddings.append(self.gat_layers[i](block, x, edge_weight=edge_weight).flatten(1))
+            return self.semantic_attention(torch.stack(semantic_embeddings, dim=1), population_scores)
+
+        rows, cols, values = [], [], []
+        for i, (dst, src, weight) in enumerate(blocks):
+            rows.append(dst + i * num_dst)
+            cols.append(src)
+            values.append(weight)
+        stacked = torch.sparse_coo_tensor(torch.stack([torch.cat(rows), torch.cat(cols)]), torch.cat(values),
+                                          size=(len(blocks) * num_dst, num_src))
+        semantic_embeddings = torch.sparse.mm(stacked, x.flatten(1)).view(len(blocks), num_dst, -1)
+        return self.semantic_attention(semantic_embeddings.transpose(0, 1), population_scores)  # (num_dst, D * K)
+
+    def forward_sampled(self, g, h, seeds, num_layers=1):
+        r"""Metapath aggregation of ``seeds`` only, over neighbors sampled with ``fanout`` per metapath.
+
+        The receptive field is sampled top-down, one layer of blocks per HAN layer, then aggregated
+        bottom-up, so the cost depends on ``len(seeds)`` and the fanout rather than on the number of nodes.
+        The metapath weights use the population scores of ``refresh_population_scores`` when available;
+        averaging the semantic scores over the seeds alone would make them depend on the batch.
+
+        Args:
+            h (torch.Tensor): [N, D] input features of all nodes of this type.
+            seeds (torch.Tensor): Unique node ids whose output is required.
+            num_layers (int): Number of times the layer is applied, as ``HDCL.han_layers``.
+
+        Returns:
+            torch.Tensor: [len(seeds), D * K] outputs, aligned with ``seeds``.
+        """
+        self._prepare(g)
+        if self._in_neighbors is None or self._in_neighbors[self.meta_path_patterns[0]][0].device != h.device:
+            self._in_neighbors = {}
             for meta_path_pattern in self.meta_path_patterns:
-                self._cached_coalesced_graph[meta_path_pattern] = dgl.metapath_reachable_graph(
-                    g, meta_path_pattern)
+                adj = (self._cached_adj[meta_path_pattern] != 0).astype(np.float32)  # [src, dst]
+                out_degree = np.maximum(np.asarray(adj.sum(axis=1)).ravel(), 1.).astype(np.float32)
+                adj = adj.T.tocsr()  # [dst, src]
+                self._in_neighbors[meta_path_pattern] = (torch.from_numpy(adj.indptr.astype(np.int64)).to(h.device),
+                                                         torch.from_numpy(adj.indices.astype(np.int64)).to(h.device),
+                                                         torch.from_numpy(out_degree).to(h.device))
+        layers, nodes = [], seeds
+        for _ in range(num_layers):
+            blocks, src_nodes = self._sample_blocks(nodes)
+            layers.append((blocks, len(nodes)))
+            nodes = src_nodes
+        x = h[nodes]
+        for depth, (blocks, num_dst) in enumerate(reversed(layers)):
+            population_scores = self._population_scores[depth] if self._population_scores is not None else None
+            x = self._maybe_checkpoint(self._aggregate_blocks, blocks, x, num_dst, population_scores)
+        return x
+
+    @torch.no_grad()
+    def refresh_population_scores(self, g, h, num_layers=1):
+        """在全图上 (不求导) 计算每层语义注意力在全体节点上的平均得分, 供采样训练使用"""
+        self._prepare(g)
+        self._population_scores = []
+        for _ in range(num_layers):
+            z = self._aggregate(h)
+            self._population_scores.append(self.semantic_attention.scores(z))
+            h = self.semantic_attention(z, self._population_scores[-1])
+
+    def _maybe_checkpoint(self, function, *args):
+        if self.checkpointing and torch.is_grad_enabled():
+            return checkpoint(function, *args, use_reentrant=False)
+        return function(*args)
+
+    def _aggregate(self, h):
+        """所有元路径上的归一化聚合, 返回 (N, M, D * K)"""
+        semantic_embeddings = []
+        if self.fused:
+            if self._stacked_adj is None or self._stacked_adj.device != h.device:
+                self._stacked_adj = self._stack_normalized_adj(h.device)
+            semantic_embeddings = torch.sparse.mm(self._stacked_adj, h.flatten(1))  # (M * N, D * K)
+            semantic_embeddings = semantic_embeddings.view(len(self.meta_path_patterns), h.shape[0], -1)
+            return semantic_embeddings.transpose(0, 1)
 
         for i, meta_path_pattern in enumerate(self.meta_path_patterns):
-            new_g = self._cached_coalesced_graph[meta_path_pattern]
+            new_g = self._coalesced_graph(meta_path_pattern)
             # new_g = dgl.to_homogeneous(new_g)
             # coo = new_g.adj(scipy_fmt='coo', etype='_E')
             # csr_matrix = coo.tocsr()
             # semantic_embeddings.append(self.gat_layers[i](h, csr_matrix).flatten(1))
-            semantic_embeddings.append(self.gat_layers[i](new_g, h).flatten(1))
-        semantic_embeddings = torch.stack(semantic_embeddings, dim=1)  # (N, M, D * K)
+            semantic_embeddings.append(self._maybe_checkpoint(self.gat_layers[i], new_g, h).flatten(1))
+        return torch.stack(semantic_embeddings, dim=1)  # (N, M, D * K)
 
-        return self.semantic_attention(semantic_embeddings)  # (N, D * K)
+    def _self_weights(self, device):
+        """[N, M] 每个节点在各元路径图中自环边的归一化权重 (无自环为 0)"""
+        if self._self_weight is None or self._self_weight.device != torch.device(device):
+            weights = []
+            for meta_path_pattern in self.meta_path_patterns:
+                adj = (self._cached_adj[meta_path_pattern] != 0).astype(np.float32)
+                out_degree = np.maximum(np.asarray(adj.sum(axis=1)).ravel(), 1.)
+                in_degree = np.maximum(np.asarray(adj.sum(axis=0)).ravel(), 1.)
+                weights.append(adj.diagonal() * np.power(in_degree, -0.5) * np.power(out_degree, -0.5))
+            self._self_weight = torch.from_numpy(np.stack(weights, axis=1).astype(np.float32)).to(device)
+        return self._self_weight
+
+    def forward(self, g, h, history_slot=None, refresh_history=False, nodes=None):
+        r"""Metapath aggregation followed by semantic attention.
+
+        With ``history_slot`` the neighbor part of the aggregation comes from a table cached under that slot,
+        recomputed only when ``refresh_history`` is set (or the slot is empty); the self-loop term is always
+        computed from the live ``h``. The rows of ``nodes`` (the nodes the losses read) are aggregated live
+        from their metapath neighbors in ``h``, GNNAutoScale style, so their gradient reaches the neighbors;
+        their fresh neighbor parts are pushed into the cached table.
+        """
+        self._prepare(g)
+        if history_slot is None:
+            if self.fused:
+                # 融合路径只有一次 SpMM, 聚合与注意力一起重算
+                return self._maybe_checkpoint(lambda x: self.semantic_attention(self._aggregate(x)), h)
+            return self._maybe_checkpoint(self.semantic_attention, self._aggregate(h))  # (N, D * K)
+
+        self_term = self._self_weights(h.device).unsqueeze(2) * h.flatten(1).unsqueeze(1)  # (N, M, D * K)
+        if refresh_history or history_slot not in self._history:
+            with torch.no_grad():
+                self._history[history_slot] = self._aggregate(h) - self_term
+        z = self._history[history_slot] + self_term
+        if nodes is not None:
+            live = self._aggregate_rows(h, nodes)
+            z = z.index_copy(0, nodes, live)
+            with torch.no_grad():
+                self._history[history_slot][nodes] = live - self_term[nodes]
+        return self._maybe_checkpoint(self.semantic_attention, z)
+
+    def _aggregate_rows(self, h, nodes):
+        """只对 nodes 在所有元路径上做归一化聚合, 返回 (len(nodes), M, D * K); 与 _aggregate 的对应行相同"""
+        if self._stacked_adj is None or self._stacked_adj.device != h.device:
+            self._stacked_adj = self._stack_normalized_adj(h.device)
+        n_metapaths = len(self.meta_path_patterns)
+        rows = (torch.arange(n_metapaths, device=h.device).unsqueeze(1) * h.shape[0] + nodes).flatten()
+        aggregated = torch.sparse.mm(select_rows(self._stacked_adj, rows), h.flatten(1))
+        return aggregated.view(n_metapaths, len(nodes), -1).transpose(0, 1)
+
+    def reset_history(self):
+        self._history.clear()
 
 
 class LightGCN(nn.Module):
@@ -85,63 +393,130 @@ class LightGCN(nn.Module):
         self.n_users = self.g.num_nodes(userkey)  # 用户数量
         self.n_items = self.g.num_nodes(itemkey)  # 物品数量
         n_nodes = self.n_users + self.n_items  # 总节点数
+        self.device = args.device
 
-        # 构建邻接矩阵（未修改）
-        row_idx = []
-        col_idx = []
+        # 构建邻接矩阵: 直接由 CSR 的 indptr/indices 展开行列索引
         adj = g.adj_external(ctx='cpu', scipy_fmt='csr', etype=args.ui_relation)
-        for i in range(adj.shape[0]):
-            start = adj.indptr[i]
-            end = adj.indptr[i + 1]
-            cols = adj.indices[start:end]
-            for col in cols:
-                row_idx.append(i)
-                col_idx.append(col)
-        col_idx = [idx + self.n_users for idx in col_idx]
-        row_np = np.array(row_idx, dtype=np.int32)
-        col_np = np.array(col_idx, dtype=np.int32)
+        row_np = np.repeat(np.arange(adj.shape[0], dtype=np.int32), np.diff(adj.indptr))
+        col_np = adj.indices.astype(np.int32) + self.n_users
         ratings = np.ones_like(row_np, dtype=np.float32)
         tmp_adj = sp.csr_matrix((ratings, (row_np, col_np)), shape=(n_nodes, n_nodes), dtype=np.float32)
-        self.ui_adj = tmp_adj + tmp_adj.T
+        self.ui_adj = (tmp_adj + tmp_adj.T).tocsr()
         self.plain_adj = self.ui_adj
-        rows, cols = self.ui_adj.nonzero()
-        self.all_h_list = rows
-        self.all_t_list = cols
-        self.A_in_shape = self.plain_adj.tocoo().shape
-        self.A_indices = torch.tensor([self.all_h_list, self.all_t_list], dtype=torch.long).cuda()
-        self.D_indices = torch.tensor(
-            [list(range(self.n_users + self.n_items)), list(range(self.n_users + self.n_items))],
-            dtype=torch.long).cuda()
-        self.all_h_list = torch.LongTensor(self.all_h_list).cuda()
-        self.all_t_list = torch.LongTensor(self.all_t_list).cuda()
-        self.G_indices, self.G_values = self._cal_sparse_adj()
+        self.A_in_shape = self.plain_adj.shape
+        self.adj_norm = getattr(args, 'adj_norm', 'sym')
+        self.self_loop = bool(getattr(args, 'self_loop', 0))
+        self.G = self._cal_sparse_adj(self.adj_norm, self.self_loop)
 
         # 模型参数
         self.emb_dim = args.in_size  # 嵌入维度
-        self.n_layers = 1  # GNN层数
+        self.n_layers = getattr(args, 'n_layers', 1)  # GNN层数
+        self.checkpointing = bool(getattr(args, 'checkpointing', 0))  # 不保留每层的传播输出
         self.n_intents = 128  # 意图数量
         self.temp = 1  # 温度参数
         self.batch_size = args.batch_size  # 批次大小
         self.emb_reg = 2.5e-5  # 嵌入正则化系数
         self.cen_reg = 5e-3  # 中心正则化系数
         self.ssl_reg = 1e-1  # 自监督正则化系数
+        self.fused_propagation = bool(getattr(args, 'fused_propagation', 1))  # 三个视图融合为一次 SpMM
+
+        # Cluster-GCN 式分区训练: 启动时划分一次, 训练步只在采样的分区及其边界上传播
+        self.num_partitions = getattr(args, 'partitions', 0)
+        self.node_parts = None
+        self._step_adj = None
+        self._history = None  # 历史嵌入: (邻居部分, 两个视图的噪声, 每层 SpMM 输出)
+        if self.num_partitions > 0:
+            self.node_parts = label_propagation_partition(self.plain_adj, self.num_partitions, self.n_users,
+                                                          max_iter=getattr(args, 'partition_iters', 10),
+                                                          seed=getattr(args, 'seed', 2023))
+            self._index_partition_edges()
 
         # 0层扰动参数
         self.epsilon = args.epsilon if hasattr(args, 'epsilon') else 0.1  # 噪声幅度，可调超参数
         self.initial_embeddings = nn.Parameter(torch.empty(n_nodes, self.emb_dim))  # 初始嵌入
         nn.init.xavier_normal_(self.initial_embeddings)  # 使用Xavier正态分布初始化嵌入
 
-    def _cal_sparse_adj(self):
-        # 计算稀疏邻接矩阵（未修改）
-        A_values = torch.ones(size=(len(self.all_h_list), 1)).view(-1).cuda()
-        A_tensor = torch_sparse.SparseTensor(row=self.all_h_list, col=self.all_t_list, value=A_values,
-                                             sparse_sizes=self.A_in_shape).cuda()
-        D_values = A_tensor.sum(dim=1).pow(-0.5)
-        G_indices, G_values = torch_sparse.spspmm(self.D_indices, D_values, self.A_indices, A_values,
-                                                  self.A_in_shape[0], self.A_in_shape[1], self.A_in_shape[1])
-        G_indices, G_values = torch_sparse.spspmm(G_indices, G_values, self.D_indices, D_values, self.A_in_shape[0],
-                                                  self.A_in_shape[1], self.A_in_shape[1])
-        return G_indices, G_values
+    def _cal_sparse_adj(self, norm='sym', self_loop=False):
+        """
+        计算归一化邻接矩阵, 以 int32 索引的 CSR 张量返回.
+        按度数逐元素缩放边权, 不再构造对角矩阵做两次 spspmm:
+            sym:   D^-1/2 A D^-1/2
+            left:  D^-1 A
+            right: A D^-1
+        self_loop 为 True 时先令 A = A + I.
+        """
+        adj = self.plain_adj
+        if self_loop:
+            adj = (adj + sp.eye(adj.shape[0], dtype=np.float32, format='csr')).tocsr()
+        adj.sort_indices()
+        rows = np.repeat(np.arange(adj.shape[0]), np.diff(adj.indptr))
+        cols = adj.indices
+        degree = np.asarray(adj.sum(axis=1), dtype=np.float64).ravel()
+        with np.errstate(divide='ignore'):
+            if norm == 'sym':
+                d_inv = np.power(degree, -0.5)
+                d_inv[np.isinf(d_inv)] = 0.
+                values = adj.data * d_inv[rows] * d_inv[cols]
+            elif norm == 'left':
+                d_inv = np.power(degree, -1.0)
+                d_inv[np.isinf(d_inv)] = 0.
+                values = adj.data * d_inv[rows]
+            elif norm == 'right':
+                d_inv = np.power(degree, -1.0)
+                d_inv[np.isinf(d_inv)] = 0.
+                values = adj.data * d_inv[cols]
+            else:
+                raise NotImplementedError("Make sure 'norm' in ['sym', 'left', 'right']!")
+        return torch.sparse_csr_tensor(torch.from_numpy(adj.indptr.astype(np.int32)),
+                                       torch.from_numpy(cols.astype(np.int32)),
+                                       torch.from_numpy(values.astype(np.float32)),
+                                       size=self.A_in_shape, device=self.device)
+
+    def _index_partition_edges(self):
+        """把 self.G 的边按行节点所在分区排序, 并记录每条边的反向边, 供 use_partitions 按分区取边"""
+        n_nodes = self.A_in_shape[0]
+        crow, cols = self.G.crow_indices().long(), self.G.col_indices().long()
+        rows = torch.repeat_interleave(torch.arange(n_nodes, device=crow.device), crow[1:] - crow[:-1])
+        # CSR 中的边按 (行, 列) 有序, 邻接矩阵对称, 反向边可二分查找
+        self._edge_rows, self._edge_cols, self._edge_values = rows, cols, self.G.values()
+        self._edge_ptr = crow
+        self._reverse_edge = torch.searchsorted(rows * n_nodes + cols, cols * n_nodes + rows)
+        row_parts = torch.from_numpy(self.node_parts).to(rows.device)[rows]
+        self._part_edges = torch.argsort(row_parts, stable=True)
+        self._part_ptr = torch.cat([row_parts.new_zeros(1),
+                                    torch.cumsum(torch.bincount(row_parts, minlength=self.num_partitions), 0)]).tolist()
+
+    def use_partitions(self, parts=None, nodes=None):
+        r"""Restricts training propagation to the given partitions plus their one-hop boundary.
+
+        The step adjacency keeps every edge into a node of ``parts`` or of ``nodes`` and the reverse of those
+        edges, so these nodes aggregate exactly as on the full graph (for a single layer), the boundary nodes
+        only receive from them and all other rows receive nothing. ``nodes`` holds the positive items of the
+        step that lie outside ``parts``, which would otherwise be scored from a fraction of their neighbors
+        while the negatives, drawn inside ``parts``, are exact. ``None`` restores full-graph training;
+        inference always uses the full graph.
+
+        Args:
+            parts (iterable): Partition ids of the step.
+            nodes (torch.Tensor): Extra node ids (items offset by ``n_users``) whose full neighborhood is kept.
+        """
+        if parts is None:
+            self._step_adj = None
+            return
+        edges = [self._part_edges[self._part_ptr[part]:self._part_ptr[part + 1]] for part in parts]
+        if nodes is not None and len(nodes) > 0:
+            nodes = torch.as_tensor(nodes, device=self._edge_ptr.device).long()
+            start = self._edge_ptr[nodes]
+            degree = self._edge_ptr[nodes + 1] - start
+            offsets = torch.arange(int(degree.sum()), device=start.device) - \
+                (torch.cumsum(degree, 0) - degree).repeat_interleave(degree)
+            edges.append(start.repeat_interleave(degree) + offsets)
+        edges = torch.cat(edges)
+        edges = torch.unique(torch.cat([edges, self._reverse_edge[edges]]))  # 升序即 CSR 顺序
+        rows = self._edge_rows[edges]
+        crow = torch.cat([rows.new_zeros(1), torch.cumsum(torch.bincount(rows, minlength=self.A_in_shape[0]), 0)])
+        self._step_adj = torch.sparse_csr_tensor(crow.int(), self._edge_cols[edges].int(), self._edge_values[edges],
+                                                 size=self.A_in_shape, device=self.G.device)
 
     def _generate_perturbed_embeddings(self, embeddings):
         """使用0层扰动生成两个增强视图的嵌入。"""
@@ -159,39 +534,111 @@ class LightGCN(nn.Module):
 
         return perturbed_emb1, perturbed_emb2
 
-    def forward(self, feature_dict):
+    def _propagate(self, embeddings, adj=None):
+        """逐层图消息传递, 跨层求和在原地累加, 返回 (跨层聚合的嵌入, 每层的 SpMM 输出)"""
+        if adj is None:
+            adj = self._step_adj if self.training and self._step_adj is not None else self.G
+        layer_embeddings = embeddings
+        final_embeddings = embeddings.clone()
+        gnn_embeddings = []
+        for i in range(self.n_layers):
+            gnn_layer_embeddings = torch.sparse.mm(adj, layer_embeddings)
+            # 邻接矩阵不需要梯度, SpMM 与加法都不为反向保存激活, 无需重算;
+            # checkpointing 时不再保留每层输出, 峰值内存与层数无关
+            if not self.checkpointing:
+                gnn_embeddings.append(gnn_layer_embeddings)
+            layer_embeddings = gnn_layer_embeddings + layer_embeddings
+            final_embeddings.add_(layer_embeddings)
+        return final_embeddings, gnn_embeddings
+
+    @torch.no_grad()
+    def _refresh_history(self):
+        """
+        在全图上传播一次三个视图并缓存去掉自身项后的结果与每层的节点表示 (历史嵌入).
+        跨层求和中节点自身嵌入的系数为 n_layers + 1, 其余部分来自邻居; 扰动噪声在两次刷新之间保持不变.
+        """
+        base_embeddings = self.initial_embeddings
+        perturbed_emb1, perturbed_emb2 = self._generate_perturbed_embeddings(base_embeddings)
+        fused_embeddings = torch.cat([base_embeddings, perturbed_emb1, perturbed_emb2], dim=1)
+        layer_embeddings = fused_embeddings
+        propagated = fused_embeddings.clone()
+        layers, gnn_embeddings = [], []
+        for i in range(self.n_layers):
+            gnn_layer_embeddings = torch.sparse.mm(self.G, layer_embeddings)
+            gnn_embeddings.append(gnn_layer_embeddings[:, :self.emb_dim])
+            layer_embeddings = gnn_layer_embeddings + layer_embeddings
+            layers.append(layer_embeddings)
+            propagated.add_(layer_embeddings)
+        # 最后一层的表示不会被其他层读取, 不必缓存
+        self._history = (propagated - (self.n_layers + 1) * fused_embeddings,
+                         perturbed_emb1 - base_embeddings, perturbed_emb2 - base_embeddings,
+                         gnn_embeddings, layers[:-1])
+
+    def _live_rows(self, fused_embeddings, nodes):
+        """
+        GNNAutoScale 式地逐层只为 nodes 计算传播结果: 第 l 层读取邻居的第 l-1 层表示,
+        nodes 内的邻居取本步的实时值, 其余取历史值 (第 0 层即当前参数, 总是实时的);
+        梯度因此经邻接矩阵流入邻居的嵌入. 新算出的各层表示写回历史缓存.
+        """
+        neighbor_embeddings, _, _, _, layers = self._history
+        adj = select_rows(self.G, nodes)
+        layer_embeddings = fused_embeddings[nodes]
+        final_embeddings = layer_embeddings
+        live_layers = []
+        for i in range(self.n_layers):
+            source = fused_embeddings if i == 0 else layers[i - 1].index_copy(0, nodes, layer_embeddings)
+            layer_embeddings = torch.sparse.mm(adj, source) + layer_embeddings
+            live_layers.append(layer_embeddings)
+            final_embeddings = final_embeddings + layer_embeddings
+        with torch.no_grad():
+            for layer, live in zip(layers, live_layers):
+                layer[nodes] = live
+            neighbor_embeddings[nodes] = final_embeddings - (self.n_layers + 1) * fused_embeddings[nodes]
+        return final_embeddings
+
+    def reset_history(self):
+        self._history = None
+
+    def forward(self, feature_dict, refresh_history=None, nodes=None):
+        """
+        refresh_history 为 None 时完整传播; 为 True/False 时使用历史嵌入 (True 先刷新缓存),
+        邻居部分取自缓存, 自身项由当前参数计算, 梯度经自身项流入 initial_embeddings;
+        nodes (物品编号加 n_users) 为本步损失读取的节点, 它们的传播在历史值上实时计算, 梯度同时流入其邻居.
+        """
         self.feature_dict = feature_dict
         base_embeddings = self.initial_embeddings
 
+        if refresh_history is not None:
+            if refresh_history or self._history is None:
+                self._refresh_history()
+            neighbor_embeddings, noise1, noise2, gnn_embeddings, _ = self._history
+            live_embeddings = torch.cat([base_embeddings, base_embeddings + noise1, base_embeddings + noise2], dim=1)
+            fused_embeddings = neighbor_embeddings + (self.n_layers + 1) * live_embeddings
+            if nodes is not None:
+                fused_embeddings = fused_embeddings.index_copy(0, nodes, self._live_rows(live_embeddings, nodes))
+            all_embeddings, all_perturbed_emb1, all_perturbed_emb2 = torch.split(fused_embeddings, self.emb_dim, 1)
+            ua_embedding, ia_embedding = torch.split(all_embeddings, [self.n_users, self.n_items], 0)
+            ua_perturbed1, ia_perturbed1 = torch.split(all_perturbed_emb1, [self.n_users, self.n_items], 0)
+            ua_perturbed2, ia_perturbed2 = torch.split(all_perturbed_emb2, [self.n_users, self.n_items], 0)
+            return (ua_embedding, ia_embedding,
+                    ua_perturbed1, ia_perturbed1,
+                    ua_perturbed2, ia_perturbed2,
+                    gnn_embeddings)
+
         # 使用0层扰动生成两个增强视图
         perturbed_emb1, perturbed_emb2 = self._generate_perturbed_embeddings(base_embeddings)
 
         # 通过GNN层处理原始嵌入和扰动嵌入
-        all_embeddings = [base_embeddings]
-        all_perturbed_emb1 = [perturbed_emb1]
-        all_perturbed_emb2 = [perturbed_emb2]
-        gnn_embeddings = []
-
-        for i in range(self.n_layers):
-            # 原始嵌入的图消息传递
-            gnn_layer_embeddings = torch_sparse.spmm(self.G_indices, self.G_values, self.A_in_shape[0],
-                                                     self.A_in_shape[1], all_embeddings[i])
-            # 增强视图1的图消息传递
-            gnn_layer_perturbed1 = torch_sparse.spmm(self.G_indices, self.G_values, self.A_in_shape[0],
-                                                     self.A_in_shape[1], all_perturbed_emb1[i])
-            # 增强视图2的图消息传递
-            gnn_layer_perturbed2 = torch_sparse.spmm(self.G_indices, self.G_values, self.A_in_shape[0],
-                                                     self.A_in_shape[1], all_perturbed_emb2[i])
-
-            gnn_embeddings.append(gnn_layer_embeddings)
-            all_embeddings.append(gnn_layer_embeddings + all_embeddings[i])
-            all_perturbed_emb1.append(gnn_layer_perturbed1 + all_perturbed_emb1[i])
-            all_perturbed_emb2.append(gnn_layer_perturbed2 + all_perturbed_emb2[i])
-
-        # 跨层聚合嵌入
-        all_embeddings = torch.stack(all_embeddings, dim=1).sum(dim=1, keepdim=False)
-        all_perturbed_emb1 = torch.stack(all_perturbed_emb1, dim=1).sum(dim=1, keepdim=False)
-        all_perturbed_emb2 = torch.stack(all_perturbed_emb2, dim=1).sum(dim=1, keepdim=False)
+        if self.fused_propagation:
+            # 三个视图沿特征维拼接, 每层只需一次 [N, 3D] 的 SpMM
+            fused_embeddings = torch.cat([base_embeddings, perturbed_emb1, perturbed_emb2], dim=1)
+            fused_embeddings, fused_gnn_embeddings = self._propagate(fused_embeddings)
+            all_embeddings, all_perturbed_emb1, all_perturbed_emb2 = torch.split(fused_embeddings, self.emb_dim, 1)
+            gnn_embeddings = [layer[:, :self.emb_dim] for layer in fused_gnn_embeddings]
+        else:
+            all_embeddings, gnn_embeddings = self._propagate(base_embeddings)
+            all_perturbed_emb1, _ = self._propagate(perturbed_emb1)
+            all_perturbed_emb2, _ = self._propagate(perturbed_emb2)
 
         # 分割为用户和物品嵌入
         ua_embedding, ia_embedding = torch.split(all_embeddings, [self.n_users, self.n_items], 0)
@@ -203,6 +650,12 @@ class LightGCN(nn.Module):
                 ua_perturbed2, ia_perturbed2,
                 gnn_embeddings)
 
+    def inference(self):
+        """推理时只在全图上传播原始嵌入, 不生成扰动视图"""
+        all_embeddings, _ = self._propagate(self.initial_embeddings, self.G)
+        ua_embedding, ia_embedding = torch.split(all_embeddings, [self.n_users, self.n_items], 0)
+        return ua_embedding, ia_embedding
+
 
 class ComputeSimilarity:
     def __init__(self, model, dataMatrix, topk=10, shrink=0, normalize=True):
@@ -232,115 +685,140 @@ class ComputeSimilarity:
 
         self.model = model
 
-    def compute_similarity(self, method, block_size=100):
+    def compute_similarity(self, method, block_size=1000):
         r"""Compute the similarity for the given dataset
 
         Args:
             method (str) : Caculate the similarity of users if method is 'user', otherwise, calculate the similarity of items.
-            block_size (int): divide matrix to :math:`n\_rows \div block\_size` to calculate cosine_distance if method is 'user',
-                 otherwise, divide matrix to :math:`n\_columns \div block\_size`.
+            block_size (int): number of users (or items) whose similarities are computed by one sparse block product.
 
         Returns:
 
-            list: The similar nodes, if method is 'user', the shape is [number of users, neigh_num],
-            else, the shape is [number of items, neigh_num].
-            scipy.sparse.csr_matrix: sparse matrix W, if method is 'user', the shape is [self.n_rows, self.n_rows],
-            else, the shape is [self.n_columns, self.n_columns].
+            numpy.ndarray: The similar nodes, if method is 'user', the shape is [number of users, TopK],
+            else, the shape is [number of items, TopK], sorted by similarity and padded with -1.
+            numpy.ndarray: The similarities of the nodes above, padded with 0.
         """
-
-        user_similar_neighbors_mat, item_similar_neighbors_mat = [], []
-        user_similar_neighbors_weights_mat, item_similar_neighbors_weights_mat = [], []
-
-        values = []
-        rows = []
-        cols = []
-        neigh = []
-
-        self.dataMatrix = self.dataMatrix.astype(np.float32)
-
-        # Compute sum of squared values to be used in normalization
-        if method == 'user':
-            sumOfSquared = np.array(self.dataMatrix.power(2).sum(axis=1)).ravel()
-            end_local = self.n_rows
-        elif method == 'item':
-            sumOfSquared = np.array(self.dataMatrix.power(2).sum(axis=0)).ravel()
-            end_local = self.n_columns
-        else:
+        if method not in ('user', 'item'):
             raise NotImplementedError("Make sure 'method' in ['user', 'item']!")
-        sumOfSquared = np.sqrt(sumOfSquared)
+        return self.compute_user_item_similarity(block_size, n_jobs=1, methods=(method,))[method]
 
-        start_block = 0
+    def compute_user_item_similarity(self, block_size=1000, n_jobs=2, methods=('user', 'item')):
+        r"""Compute the similarities of users and items together, the row blocks of both run in a process pool.
 
-        # Compute all similarities using vectorization
-        while start_block < end_local:
-
-            end_block = min(start_block + block_size, end_local)
-            this_block_size = end_block - start_block
-
-            # All data points for a given user or item
-            if method == 'user':
-                data = self.dataMatrix[start_block:end_block, :]
-            else:
-                data = self.dataMatrix[:, start_block:end_block]
-            data = data.toarray().squeeze()
-
-            if data.ndim == 1:  # 如果 data 是一维数组，将其扩展为二维数组
-                data = np.expand_dims(data, axis=1)
-
-            # Compute similarities
-
-            if method == 'user':
-                this_block_weights = self.dataMatrix.dot(data.T)
-            else:
-                this_block_weights = self.dataMatrix.T.dot(data)
-
-            for index_in_block in range(this_block_size):
-
-                if this_block_size == 1:
-                    this_line_weights = this_block_weights.squeeze()
-                else:  # 提取当前 index_in_block 的相似度
-                    this_line_weights = this_block_weights[:, index_in_block]
-
-                Index = index_in_block + start_block
-                this_line_weights[Index] = 0.0  # 设置自身相似度为0：防止用户或物品与自己进行比较
-
-                # Apply normalization and shrinkage, ensure denominator != 0
-                if self.normalize:
-                    denominator = sumOfSquared[Index] * sumOfSquared + self.shrink + 1e-6
-                    this_line_weights = np.multiply(this_line_weights, 1 / denominator)
-
-                elif self.shrink != 0:
-                    this_line_weights = this_line_weights / self.shrink
-
-                # Sort indices and select TopK
-                # Sorting is done in three steps. Faster then plain np.argsort for higher number of users or items
-                # - Partition the data to extract the set of relevant users or items
-                # - Sort only the relevant users or items
-                # - Get the original index
-                # argpartition 可以快速找到前 TopK 个最大相似度值的索引，但这些索引对应的值并不是完全排序的，只是保证了这 TopK 个值是最大的
-                relevant_partition = (-this_line_weights).argpartition(self.TopK - 1)[0:self.TopK]
-                # argsort 对 argpartition 找到的前 TopK 个值进行降序排序，确保我们得到的是从大到小排列的前 TopK 个相似度值的索引
-                relevant_partition_sorting = np.argsort(-this_line_weights[relevant_partition])
-                top_k_idx = relevant_partition[relevant_partition_sorting]
-                neigh.append(top_k_idx)
+        Returns:
+            dict: method -> (neighbors, weights) padded arrays, see ``compute_similarity``.
+        """
+        matrices = {}
+        if 'user' in methods:
+            matrices['user'] = self.dataMatrix
+        if 'item' in methods:
+            matrices['item'] = self.dataMatrix.T
+        return topk_similarity(matrices, self.TopK, self.shrink, self.normalize, block_size, n_jobs)
 
-                # Incrementally build sparse matrix, do not add zeros
-                notZerosMask = this_line_weights[top_k_idx] != 0.0  # 把 0 值去掉
-                tmp_values = this_line_weights[top_k_idx][notZerosMask]
 
-                if method == 'user':
-                    user_similar_neighbors_mat.append(top_k_idx[notZerosMask])  # 具体的最近邻居的id, 把 0 值去掉了
-                    user_similar_neighbors_weights_mat.append(tmp_values)  # 具体的最近邻居的相似度值
-                else:
-                    item_similar_neighbors_mat.append(top_k_idx[notZerosMask])
-                    item_similar_neighbors_weights_mat.append(tmp_values)
+class BatchedKMeans:
+    def __init__(self, n_clusters, max_iter=100, batch_size=4096, chunk_size=16384, seed=42):
+        r"""Mini-batch k-means in torch that clusters many groups of points in one vectorized pass.
 
-            start_block += block_size
+        Every group (e.g. the members of one parent cluster) is split into ``min(n_clusters, group size)``
+        clusters independently. Seeding (k-means++) and the mini-batch updates run for all groups at once.
 
-        if method == 'user':
-            return user_similar_neighbors_mat, user_similar_neighbors_weights_mat
-        elif method == 'item':
-            return item_similar_neighbors_mat, item_similar_neighbors_weights_mat
+        Args:
+            n_clusters (int): Number of clusters per group.
+            max_iter (int): Number of mini-batch updates.
+            batch_size (int): Number of points sampled for each update.
+            chunk_size (int): Number of points assigned at once.
+            seed (int): Seed of the seeding and the mini-batch sampling.
+        """
+        self.n_clusters = n_clusters
+        self.max_iter = max_iter
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.seed = seed
+
+    def _assign(self, x, groups, centroids, valid):
+        """返回每个点在其组内最近质心的全局编号 (group * n_clusters + j)"""
+        k = self.n_clusters
+        centroids = centroids.view(-1, k, centroids.shape[-1])
+        centroid_norm = centroids.pow(2).sum(-1).masked_fill(~valid.view(-1, k), float('inf'))
+        assign = torch.empty(len(x), dtype=torch.long, device=x.device)
+        for start in range(0, len(x), self.chunk_size):
+            end = min(start + self.chunk_size, len(x))
+            # 按组排序后切成至多 rows 行的段并填充为 (S, rows, D), 每段只与所属组的 k 个质心做一次 bmm;
+            # rows 取 chunk 大小 / 组数, 填充总量不超过 chunk 的两倍, 不会随最大的组增长
+            present, group, counts = torch.unique(groups[start:end], return_inverse=True, return_counts=True)
+            order = torch.argsort(group)
+            rank = torch.arange(end - start, device=x.device) - (torch.cumsum(counts, 0) - counts)[group[order]]
+            rows = min(-(-(end - start) // len(present)), int(counts.max()))
+            segments = -(-counts // rows)
+            segment = (torch.cumsum(segments, 0) - segments)[group[order]] + rank // rows
+            segment_group = present[torch.repeat_interleave(torch.arange(len(present), device=x.device), segments)]
+            padded = x.new_zeros(int(segments.sum()), rows, x.shape[1])
+            padded[segment, rank % rows] = x[start:end][order]
+            # ||c||^2 - 2 x.c, 与 ||x - c||^2 只差一个与 j 无关的常数
+            distance = torch.baddbmm(centroid_norm[segment_group].unsqueeze(1), padded,
+                                     centroids[segment_group].transpose(1, 2), alpha=-2)
+            assign[start + order] = present[group[order]] * k + distance[segment, rank % rows].argmin(dim=1)
+        return assign
+
+    def _seed(self, x, groups, sizes, generator):
+        """k-means++ 初始化, 每一步为所有组同时按 D^2 概率各选一个新质心"""
+        n, k = x.shape[0], self.n_clusters
+        n_groups = len(sizes)
+        index = torch.arange(n, device=x.device)
+        centroids = torch.zeros(n_groups * k, x.shape[1], device=x.device)
+        min_distance = torch.full((n,), float('inf'), device=x.device)
+        for j in range(k):
+            active = sizes > j
+            if not bool(active.any()):
+                break
+            # 指数竞争采样: argmin(E / D^2) 服从按 D^2 加权的抽样; 第一步还没有质心, 直接取 argmin(E) 即均匀抽样
+            race = torch.empty(n, device=x.device).exponential_(generator=generator)
+            if j > 0:
+                race = race / min_distance.clamp(min=1e-12)
+            race[~active[groups]] = float('inf')
+            best = torch.full((n_groups,), float('inf'), device=x.device).scatter_reduce(0, groups, race, 'amin')
+            winner = torch.full((n_groups,), -1, dtype=torch.long, device=x.device)
+            is_best = race == best[groups]
+            winner.scatter_(0, groups[is_best], index[is_best])
+            chosen = active & (winner >= 0)
+            centroids[torch.nonzero(chosen).squeeze(1) * k + j] = x[winner[chosen]]
+            new_distance = (x - centroids[groups * k + j]).pow(2).sum(-1)
+            min_distance = torch.where(active[groups], torch.minimum(min_distance, new_distance), min_distance)
+            min_distance[winner[chosen]] = 0.
+        return centroids
+
+    @torch.no_grad()
+    def fit_predict(self, x, groups=None):
+        """
+        x: (N, D) 待聚类的嵌入; groups: (N,) 父簇编号, None 表示所有点属于同一组.
+        返回 (N,) 的组内簇标签; 只有一个点的组标签为 0.
+        """
+        n, k = x.shape[0], self.n_clusters
+        x = x.float()
+        generator = torch.Generator(device=x.device).manual_seed(self.seed)
+        groups = torch.zeros(n, dtype=torch.long, device=x.device) if groups is None else groups.long().to(x.device)
+        n_groups = int(groups.max()) + 1
+        sizes = torch.bincount(groups, minlength=n_groups)
+        valid = (torch.arange(k, device=x.device).unsqueeze(0) < sizes.clamp(max=k).unsqueeze(1)).view(-1)
+
+        centroids = self._seed(x, groups, sizes, generator)
+        counts = torch.zeros(n_groups * k, device=x.device)
+
+        # mini-batch 更新: 每个质心按累计样本数 1/v 的学习率移动
+        for _ in range(self.max_iter):
+            batch = torch.randint(n, (min(self.batch_size, n),), generator=generator, device=x.device)
+            assign = self._assign(x[batch], groups[batch], centroids, valid)
+            batch_counts = torch.bincount(assign, minlength=n_groups * k).float()
+            batch_sums = torch.zeros_like(centroids).index_add_(0, assign, x[batch])
+            counts += batch_counts
+            updated = batch_counts > 0
+            centroids[updated] += (batch_sums[updated] - batch_counts[updated].unsqueeze(1) * centroids[updated]) \
+                / counts[updated].unsqueeze(1)
+
+        labels = self._assign(x, groups, centroids, valid) - groups * k
+        labels[sizes[groups] <= 1] = 0
+        return labels
 
 
 class HDCL(nn.Module):
@@ -352,7 +830,13 @@ class HDCL(nn.Module):
         self.unum = self.n_users = self.g.num_nodes(user_key)
         self.inum = self.n_items = self.g.num_nodes(item_key)
         self.device = args.device
-        self.han_layers = 1
+        self.han_layers = getattr(args, 'han_layers', 1)
+        # 元路径分支的邻居采样训练: fanout 非 0 时每个 batch 只在其感受野上运行 HAN
+        self.han_fanout = eval(str(getattr(args, 'han_fanout', 0)))
+        self.han_sampled = bool(self.han_fanout)
+        # 采样训练时每隔 han_attention_interval 步在全图上刷新一次语义注意力得分, 0 只用 batch 内的均值 (有偏)
+        self.han_attention_interval = getattr(args, 'han_attention_interval', 50)
+        self._attention_age = None
 
         self.initializer = nn.init.xavier_uniform_
         self.feature_dict = nn.ParameterDict({
@@ -361,9 +845,20 @@ class HDCL(nn.Module):
         self.LightGCN = LightGCN(g, args)
         # metapath-based aggregation modules for user and item, this produces h2
         self.meta_path_patterns = args.meta_path_patterns
+        # 元路径可达图按数据集缓存在 <data_path>/<dataset>/metapath.cache/ 下
+        metapath_cache = None
+        if getattr(args, 'metapath_cache', 1) and hasattr(args, 'dataset'):
+            metapath_cache = os.path.join(args.data_path + args.dataset, 'metapath.cache')
         # one HANLayer for user, one HANLayer for item
         self.hans = nn.ModuleDict({
-            key: HANLayer(value, args.in_size, args.out_size, args.num_heads, args.dropout) for key, value in
+            key: HANLayer(value, args.in_size, args.out_size, args.num_heads, args.dropout,
+                          fused=bool(getattr(args, 'han_fused_spmm', 1)), cache_dir=metapath_cache,
+                          n_threads=getattr(args, 'metapath_threads', 4),
+                          topk=eval(str(getattr(args, 'metapath_topk', 0))),
+                          topk_score=getattr(args, 'metapath_topk_score', 'count'),
+                          topk_seed=getattr(args, 'seed', 2023),
+                          fanout=self.han_fanout,
+                          checkpointing=bool(getattr(args, 'checkpointing', 0))) for key, value in
             self.meta_path_patterns.items()
         })
 
@@ -377,132 +872,272 @@ class HDCL(nn.Module):
         self.cluster_labels = {'user': [], 'item': []}
         self._compute_multi_level_clusters(args)
         self.head_persent=args.head_persent
+        # 各层簇标签加上锚点偏移后的堆叠形式 [L, N], 用于一次性 gather 所有层的锚点
+        self.stacked_cluster_labels = {}
+        self._stack_cluster_labels()
+        self.register_buffer('level_weights', 1.0 / torch.arange(1, self.cluster_level + 1, dtype=torch.float32,
+                                                                 device=self.device), persistent=False)
 
 
         self.ssl_temp = 0.1
+        self.ssl_chunk_size = getattr(args, 'ssl_chunk_size', 1024)  # InfoNCE 与 uniformity 每块的 anchor 数
+        self.uniformity_mode = getattr(args, 'uniformity', 'exact')
+        # 对比学习的负样本队列 (memory bank), 首次入队时按嵌入维度创建
+        self.ssl_queue_size = getattr(args, 'ssl_queue_size', 0)
+        self.ssl_queue = None
+        self.ssl_queue_ptr = 0
+        self.ssl_queue_filled = 0
+        self.uniformity_pairs = getattr(args, 'uniformity_pairs', 4096)
         self.cl_rate = args.cl_rate
         self.ts=args.ts
 
         self.user_similar_neighbors_mat, self.user_similar_neighbors_weights_mat, \
             self.item_similar_neighbors_mat, self.item_similar_neighbors_weights_mat = self.get_similar_users_items(
             args)
+        self.car_mode = getattr(args, 'car_mode', 'full')
+        if self.han_sampled and self.car_mode == 'full':
+            # full 模式的 CAR 节点是全体用户和物品, 采样训练会在每一步为所有节点采样感受野, 比全图 HAN 更慢
+            raise ValueError("--han_fanout requires --car_mode batch or sample!")
+        if self.LightGCN.num_partitions > 0 and self.car_mode == 'batch':
+            # batch 模式的包含概率假设样本独立抽取, 分区训练的 batch 只含少数分区的用户, 加权不再无偏
+            raise ValueError("--partitions does not support --car_mode batch, use full or sample!")
+        self.car_sample_size = getattr(args, 'car_sample_size', 4096)
+        self._compute_head_tail_partition(getattr(args, 'sample_mode', 'random'))
 
         self.gamma = args.gamma
         self.beta = args.beta
 
+        # 推理阶段的嵌入缓存: (参数版本号, 用户嵌入表, 物品嵌入表)
+        self._inference_cache = None
+
+        # 训练时复用历史传播结果: >0 每 history_interval 步刷新一次, -1 由训练循环每个 epoch 刷新, 0 关闭
+        self.history_interval = getattr(args, 'history_interval', 0)
+        self._history_age = None
+
+        # 训练中在后台线程定期对融合嵌入重新聚类, 结果在两步之间整体替换
+        self.recluster_interval = getattr(args, 'recluster_interval', 0)
+        self.recluster_iters = getattr(args, 'recluster_iters', 20)
+        self.recluster_sample_size = getattr(args, 'recluster_sample_size', 4096)
+        self._recluster_step = 0
+        self._recluster_future = None
+        self._recluster_executor = ThreadPoolExecutor(1) if self.recluster_interval > 0 else None
+        self._last_fused_embeddings = None
+
+    def _fit_cluster_labels(self, user_emb, item_emb, max_iter=None, sample_size=None):
+        """层次聚类: 第 0 层对全体聚类, 之后每层在上一层标签划分的各组内同时聚类"""
+        max_iter = self.kmeans_iters if max_iter is None else max_iter
+        sample_size = self.kmeans_sample_size if sample_size is None else sample_size
+        cluster_labels = {'user': [], 'item': []}
+        for level in range(self.cluster_level):
+            num_clusters = self.num_clusters // (2 ** level)  # 每层簇数减半
+            if num_clusters < 1:
+                num_clusters = 1  # 保证至少 1 个簇
+            kmeans = BatchedKMeans(num_clusters, max_iter=max_iter, batch_size=sample_size, seed=42)
+            for side, emb in (('user', user_emb), ('item', item_emb)):
+                groups = cluster_labels[side][level - 1] if level > 0 else None
+                cluster_labels[side].append(kmeans.fit_predict(emb, groups).to(self.device))
+        return cluster_labels
+
     def _compute_multi_level_clusters(self, args):
         """计算多层次聚类"""
+        self.kmeans_iters = getattr(args, 'kmeans_iters', 100)
+        self.kmeans_sample_size = getattr(args, 'kmeans_sample_size', 4096)
         with torch.no_grad():
-            user_emb = self.feature_dict[self.user_key].cpu().numpy()
-            item_emb = self.feature_dict[self.item_key].cpu().numpy()
+            user_emb = self.feature_dict[self.user_key].detach()
+            item_emb = self.feature_dict[self.item_key].detach()
+            self.cluster_labels = self._fit_cluster_labels(user_emb, item_emb)
 
-            # 层次聚类
             for level in range(self.cluster_level):
-                num_clusters = self.num_clusters // (2 ** level)  # 每层簇数减半
-                if num_clusters < 1:
-                    num_clusters = 1  # 保证至少 1 个簇
-
-                # 用户聚类
-                if level == 0:
-                    kmeans_users = KMeans(n_clusters=num_clusters, random_state=42).fit(user_emb)
-                    self.cluster_labels['user'].append(torch.tensor(kmeans_users.labels_, device=self.device))
-                else:
-                    prev_labels = self.cluster_labels['user'][level - 1].cpu().numpy()
-                    level_labels = np.zeros_like(prev_labels)
-                    for cluster_idx in range(self.cluster_labels['user'][level - 1].max() + 1):
-                        mask = prev_labels == cluster_idx
-                        if mask.sum() > 1:  # 确保有足够样本
-                            sub_emb = user_emb[mask]
-                            sub_kmeans = KMeans(n_clusters=min(num_clusters, mask.sum()), random_state=42).fit(sub_emb)
-                            level_labels[mask] = sub_kmeans.labels_
-                    self.cluster_labels['user'].append(torch.tensor(level_labels, device=self.device))
-
-                # 物品聚类
-                if level == 0:
-                    kmeans_items = KMeans(n_clusters=num_clusters, random_state=42).fit(item_emb)
-                    self.cluster_labels['item'].append(torch.tensor(kmeans_items.labels_, device=self.device))
-                else:
-                    prev_labels = self.cluster_labels['item'][level - 1].cpu().numpy()
-                    level_labels = np.zeros_like(prev_labels)
-                    for cluster_idx in range(self.cluster_labels['item'][level - 1].max() + 1):
-                        mask = prev_labels == cluster_idx
-                        if mask.sum() > 1:
-                            sub_emb = item_emb[mask]
-                            sub_kmeans = KMeans(n_clusters=min(num_clusters, mask.sum()), random_state=42).fit(sub_emb)
-                            level_labels[mask] = sub_kmeans.labels_
-                    self.cluster_labels['item'].append(torch.tensor(level_labels, device=self.device))
-
+                num_clusters = max(self.num_clusters // (2 ** level), 1)
                 # 初始化锚点
                 self.cluster_anchors[f'user_level_{level}'] = nn.Parameter(
                     self.initializer(torch.empty(num_clusters, args.in_size)))
                 self.cluster_anchors[f'item_level_{level}'] = nn.Parameter(
                     self.initializer(torch.empty(num_clusters, args.in_size)))
 
-    def _cluster_anchor_regularization(self, ua_embedding, ia_embedding, h2):
-        """计算多层次 CAR 损失"""
+    def _recluster(self, user_emb, item_emb):
+        """后台线程中执行: 对融合嵌入重新聚类, 并以每个簇的成员均值作为新的锚点"""
+        with torch.no_grad():
+            user_emb, item_emb = user_emb.cpu(), item_emb.cpu()
+            cluster_labels = self._fit_cluster_labels(user_emb, item_emb, self.recluster_iters,
+                                                      self.recluster_sample_size)
+            anchors = {}
+            for side, emb in (('user', user_emb), ('item', item_emb)):
+                for level in range(self.cluster_level):
+                    labels = cluster_labels[side][level].cpu()
+                    num_clusters = self.cluster_anchors[f'{side}_level_{level}'].shape[0]
+                    counts = torch.bincount(labels, minlength=num_clusters).float()
+                    sums = emb.new_zeros(num_clusters, emb.shape[1]).index_add_(0, labels, emb)
+                    anchors[f'{side}_level_{level}'] = (sums / counts.clamp(min=1).unsqueeze(1), counts > 0)
+        return cluster_labels, anchors
+
+    def _swap_clusters(self, result, optimizer=None):
+        """在训练步之间替换簇标签与锚点; 空簇保留原锚点, 被替换锚点的优化器状态清空"""
+        cluster_labels, anchors = result
+        with torch.no_grad():
+            for name, (anchor, non_empty) in anchors.items():
+                param = self.cluster_anchors[name]
+                non_empty = non_empty.to(param.device)
+                param[non_empty] = anchor.to(param.device, param.dtype)[non_empty]
+                if optimizer is not None:
+                    optimizer.state.pop(param, None)
+        self.cluster_labels = cluster_labels
+        self._stack_cluster_labels()
+
+    def maybe_recluster(self, optimizer=None):
+        """
+        每个训练步之后调用: 后台聚类完成则整体替换, 每 recluster_interval 步提交一次新的聚类任务.
+        训练循环从不等待聚类. 返回本次是否替换了簇.
+        """
+        if self.recluster_interval <= 0:
+            return False
+        swapped = False
+        if self._recluster_future is not None and self._recluster_future.done():
+            self._swap_clusters(self._recluster_future.result(), optimizer)
+            self._recluster_future = None
+            swapped = True
+        self._recluster_step += 1
+        if self._recluster_future is None and self._recluster_step % self.recluster_interval == 0:
+            if self._recluster_from_inference():
+                # 采样/分区训练不产生完整的融合嵌入表, 用全图推理补齐
+                with torch.no_grad():
+                    self._last_fused_embeddings = self.get_inference_embeddings()
+            if self._last_fused_embeddings is not None:
+                self._recluster_future = self._recluster_executor.submit(self._recluster,
+                                                                         *self._last_fused_embeddings)
+        return swapped
+
+    def _recluster_from_inference(self):
+        """训练前向只覆盖部分节点或部分图 (HAN 采样, LightGCN 分区) 时, 聚类用全图推理的嵌入表"""
+        return self.han_sampled or self.LightGCN.num_partitions > 0
+
+    def stop_reclustering(self):
+        if self._recluster_executor is not None:
+            self._recluster_executor.shutdown(wait=False, cancel_futures=True)
+            self._recluster_executor = None
+            self._recluster_future = None
+
+    def _stack_cluster_labels(self):
+        """把每层的簇标签平移到拼接后锚点表中的位置, 堆叠为 [L, N]"""
+        for side in ('user', 'item'):
+            offset = 0
+            stacked = []
+            for level in range(self.cluster_level):
+                stacked.append(self.cluster_labels[side][level].long().to(self.device) + offset)
+                offset += self.cluster_anchors[f'{side}_level_{level}'].shape[0]
+            self.stacked_cluster_labels[side] = torch.stack(stacked, dim=0)
+
+    def _compute_head_tail_partition(self, sample_mode='random'):
+        """头部/尾部划分只依赖训练图与 head_persent, 预先计算一次并常驻设备"""
+        user_counts = np.asarray(self.interaction_matrix.sum(axis=1)).ravel()
+        item_counts = np.asarray(self.interaction_matrix.sum(axis=0)).ravel()
+        user_head_mask = user_counts >= np.percentile(user_counts, self.head_persent)
+        item_head_mask = item_counts >= np.percentile(item_counts, self.head_persent)
+
+        for name, idx in (('user_head_idx', np.where(user_head_mask)[0]), ('user_tail_idx', np.where(~user_head_mask)[0]),
+                          ('item_head_idx', np.where(item_head_mask)[0]), ('item_tail_idx', np.where(~item_head_mask)[0])):
+            self.register_buffer(name, torch.from_numpy(idx).long().to(self.device), persistent=False)
+        self.register_buffer('user_is_head', torch.from_numpy(user_head_mask).to(self.device), persistent=False)
+        self.register_buffer('item_is_head', torch.from_numpy(item_head_mask).to(self.device), persistent=False)
+
+        # 训练采样器单次抽取中每个用户/正样本物品被抽到的概率, 用于 batch 模式下的 Horvitz-Thompson 加权
+        if sample_mode == 'epoch':
+            user_draw_prob = user_counts / user_counts.sum()
+            item_draw_prob = item_counts / item_counts.sum()
+        else:
+            active = user_counts > 0
+            user_draw_prob = active / active.sum()
+            inv_degree = np.zeros_like(user_counts)
+            inv_degree[active] = 1.0 / user_counts[active]
+            item_draw_prob = self.interaction_matrix.T.dot(inv_degree) / active.sum()
+        self.register_buffer('user_draw_prob', torch.from_numpy(np.asarray(user_draw_prob, dtype=np.float64)).to(
+            self.device), persistent=False)
+        self.register_buffer('item_draw_prob', torch.from_numpy(np.asarray(item_draw_prob, dtype=np.float64)).to(
+            self.device), persistent=False)
+        # 没有训练交互的节点永远不会出现在 batch 中, batch 模式下单独均匀抽样补齐它们的损失
+        for side, head_mask, draw_prob in (('user', user_head_mask, user_draw_prob),
+                                           ('item', item_head_mask, item_draw_prob)):
+            for part, mask in (('head', head_mask), ('tail', ~head_mask)):
+                idx = np.where(mask & (np.asarray(draw_prob) <= 0))[0]
+                self.register_buffer(f'{side}_{part}_undrawn_idx', torch.from_numpy(idx).long().to(self.device),
+                                     persistent=False)
+
+    def _car_nodes(self, side, part, batch_nodes=None):
+        """
+        选出参与 CAR 的节点及其权重 (权重为 None 时取均值):
+            full:   该部分的全部节点
+            sample: 均匀有放回地抽取 car_sample_size 个节点, 其均值是全量损失的无偏估计
+            batch:  当前 batch 中属于该部分的节点, 以 1 / (|part| * 包含概率) 加权; 采样器抽不到的节点 (无训练交互)
+                    另外均匀有放回地抽取至多 car_sample_size 个, 以 其占比 / 抽取数 加权, 两项之和为全量损失的无偏估计
+        """
+        idx = getattr(self, f'{side}_{part}_idx')
+        if self.car_mode == 'sample' and len(idx) > self.car_sample_size:
+            return idx[torch.randint(len(idx), (self.car_sample_size,), device=idx.device)], None
+        if self.car_mode == 'batch' and batch_nodes is not None:
+            nodes = torch.unique(batch_nodes)
+            nodes = nodes[getattr(self, f'{side}_is_head')[nodes] == (part == 'head')]
+            inclusion = 1.0 - (1.0 - getattr(self, f'{side}_draw_prob')[nodes]) ** len(batch_nodes)
+            weight = (1.0 / (len(idx) * inclusion)).float()
+            undrawn = getattr(self, f'{side}_{part}_undrawn_idx')
+            if len(undrawn) > self.car_sample_size:
+                undrawn = undrawn[torch.randint(len(undrawn), (self.car_sample_size,), device=undrawn.device)]
+                undrawn_weight = len(getattr(self, f'{side}_{part}_undrawn_idx')) / (len(idx) * self.car_sample_size)
+            else:
+                undrawn_weight = 1.0 / len(idx)
+            return torch.cat([nodes, undrawn]), torch.cat([weight, weight.new_full((len(undrawn),), undrawn_weight)])
+        return idx, None
+
+    def _level_anchor_distance(self, side, emb, idx, weight=None, detach_anchor=False):
+        """
+        所有层一次计算: 返回 [L] 的平均平方距离 (给定 weight 时为按节点加权求和).
+        detach_anchor=False 为源正则化 (L_S, 拉动锚点), True 为目标正则化 (L_T, 拉动嵌入)
+        """
+        if len(idx) == 0:
+            return torch.zeros(self.cluster_level, device=emb.device)
+        anchors = torch.cat([self.cluster_anchors[f'{side}_level_{level}'] for level in range(self.cluster_level)], 0)
+        anchors = anchors[self.stacked_cluster_labels[side][:, idx]]  # (L, n, D)
+        node_emb = emb[idx].unsqueeze(0)  # (1, n, D)
+        if detach_anchor:
+            anchors = anchors.detach()
+        else:
+            node_emb = node_emb.detach()
+        distance = (anchors - node_emb).pow(2).mean(dim=2)  # (L, n)
+        if weight is None:
+            return distance.mean(dim=1)
+        return (distance * weight).sum(dim=1)
+
+    def _draw_car_nodes(self, user_idx=None, item_idx=None):
+        """一次抽出 CAR 的全部节点: (side, part) -> (节点, 权重)"""
+        return {(side, part): self._car_nodes(side, part, batch_nodes)
+                for side, batch_nodes in (('user', user_idx), ('item', item_idx)) for part in ('head', 'tail')}
+
+    def _cluster_anchor_regularization(self, ua_embedding, ia_embedding, h2, user_idx=None, item_idx=None,
+                                       car_nodes=None):
+        """计算多层次 CAR 损失, car_mode 为 batch 时只在 user_idx/item_idx 上估计; car_nodes 为预先抽好的节点"""
         user_emb = 0.5 * ua_embedding + 0.5 * h2[self.user_key]
         item_emb = 0.5 * ia_embedding + 0.5 * h2[self.item_key]
+        if car_nodes is None:
+            car_nodes = self._draw_car_nodes(user_idx, item_idx)
 
-        # 动态头部和尾部划分
-        interaction_counts = self.interaction_matrix.sum(axis=1).A1
-        user_head_mask = interaction_counts >= np.percentile(interaction_counts, self.head_persent)
-        item_head_mask = self.interaction_matrix.sum(axis=0).A1 >= np.percentile(self.interaction_matrix.sum(axis=0).A1,
-                                                                                 self.head_persent)
-
-        user_head_idx = torch.tensor(np.where(user_head_mask)[0], device=self.device)
-        user_tail_idx = torch.tensor(np.where(~user_head_mask)[0], device=self.device)
-        item_head_idx = torch.tensor(np.where(item_head_mask)[0], device=self.device)
-        item_tail_idx = torch.tensor(np.where(~item_head_mask)[0], device=self.device)
+        # 源正则化 (L_S)
+        L_S = (self._level_anchor_distance('user', user_emb, *car_nodes[('user', 'head')], detach_anchor=False) +
+               self._level_anchor_distance('item', item_emb, *car_nodes[('item', 'head')], detach_anchor=False)) / 2.0
+        # 目标正则化 (L_T)
+        L_T = (self._level_anchor_distance('user', user_emb, *car_nodes[('user', 'tail')], detach_anchor=True) +
+               self._level_anchor_distance('item', item_emb, *car_nodes[('item', 'tail')], detach_anchor=True)) / 2.0
 
-        total_car_loss = 0
-        for level in range(self.cluster_level):
-            user_clusters = self.cluster_labels['user'][level]
-            item_clusters = self.cluster_labels['item'][level]
-
-            # 源正则化 (L_S)
-            L_S_user = torch.mean((self.cluster_anchors[f'user_level_{level}'][user_clusters[user_head_idx]] - user_emb[
-                user_head_idx].detach()) ** 2) if len(user_head_idx) > 0 else 0
-            L_S_item = torch.mean((self.cluster_anchors[f'item_level_{level}'][item_clusters[item_head_idx]] - item_emb[
-                item_head_idx].detach()) ** 2) if len(item_head_idx) > 0 else 0
-            L_S = (L_S_user + L_S_item) / 2.0 if (L_S_user > 0 or L_S_item > 0) else torch.tensor(0.0,
-                                                                                                  device=self.device)
-
-            # 目标正则化 (L_T)
-            L_T_user = torch.mean((user_emb[user_tail_idx] - self.cluster_anchors[f'user_level_{level}'][
-                user_clusters[user_tail_idx]].detach()) ** 2) if len(user_tail_idx) > 0 else 0
-            L_T_item = torch.mean((item_emb[item_tail_idx] - self.cluster_anchors[f'item_level_{level}'][
-                item_clusters[item_tail_idx]].detach()) ** 2) if len(item_tail_idx) > 0 else 0
-            L_T = (L_T_user + L_T_item) / 2.0 if (L_T_user > 0 or L_T_item > 0) else torch.tensor(0.0,
-                                                                                                  device=self.device)
-
-            # 每层损失加权（越高层权重越低）
-            level_weight = 1.0 / (level + 1)
-            total_car_loss += level_weight * (self.lambda_H * L_S + self.lambda_T * L_T)
-
-        return total_car_loss
+        # 每层损失加权（越高层权重越低）
+        return torch.sum(self.level_weights * (self.lambda_H * L_S + self.lambda_T * L_T))
 
     def get_similar_users_items(self, args):
         # load parameters info
         self.k = args.topK
         self.shrink = args['shrink'] if 'shrink' in args else 0.0  # 调节相似度计算的结果
 
-        row_idx = []
-        col_idx = []
         adj = self.g.adj_external(ctx='cpu', scipy_fmt='csr', etype=args.ui_relation)
-        for i in range(adj.shape[0]):  # 每一行代表 与目标类型id=i相连的srcType的节点ID
-            # 从 CSC 矩阵中获取第 i 列的所有非零行索引，即所有与列索引 i 有连接的节点
-            start = adj.indptr[i]
-            end = adj.indptr[i + 1]
-            cols = adj.indices[start:end]
-            # 记录行索引和列索引
-            for col in cols:
-                row_idx.append(i)
-                col_idx.append(col)
-        # 将列索引转换成物品索引，确保它们在用户索引之后
-        # col_idx = [idx + self.n_users for idx in col_idx]
-        # 转换为 NumPy 数组
-        row_np = np.array(row_idx, dtype=np.int32)
-        col_np = np.array(col_idx, dtype=np.int32)
+        # 每一行代表 与目标类型id=i相连的srcType的节点ID, 由 indptr 直接展开行索引
+        row_np = np.repeat(np.arange(adj.shape[0], dtype=np.int32), np.diff(adj.indptr))
+        col_np = adj.indices.astype(np.int32)
         # 创建一个与 user_np 相同长度的全 1 数组
         ratings = np.ones_like(row_np, dtype=np.float32)
         # 构建新的稀疏矩阵
@@ -512,15 +1147,18 @@ class HDCL(nn.Module):
         shape = interaction_matrix.shape
         assert self.n_users == shape[0] and self.n_items == shape[1]
 
-        user_similar_neighbors_mat, user_similar_neighbors_weights_mat = ComputeSimilarity(self, interaction_matrix,
-                                                                                           topk=self.k,
-                                                                                           shrink=self.shrink).compute_similarity(
-            'user')
-
-        item_similar_neighbors_mat, item_similar_neighbors_weights_mat = ComputeSimilarity(self, interaction_matrix,
-                                                                                           topk=self.k,
-                                                                                           shrink=self.shrink).compute_similarity(
-            'item')
+        similarity = ComputeSimilarity(self, interaction_matrix, topk=self.k, shrink=self.shrink)
+        similarity = similarity.compute_user_item_similarity(n_jobs=getattr(args, 'similarity_workers', 1))
+        user_similar_neighbors_mat, user_similar_neighbors_weights_mat = similarity['user']
+        item_similar_neighbors_mat, item_similar_neighbors_weights_mat = similarity['item']
+        # kNN 邻居与权重以填充后的张量常驻设备 (-1 / 0 填充), 供整批抽样
+        for name, value in (('user_similar_neighbors', user_similar_neighbors_mat),
+                            ('user_similar_weights', user_similar_neighbors_weights_mat),
+                            ('item_similar_neighbors', item_similar_neighbors_mat),
+                            ('item_similar_weights', item_similar_neighbors_weights_mat)):
+            value = torch.from_numpy(value)
+            self.register_buffer(name, (value.long() if name.endswith('neighbors') else value).to(self.device),
+                                 persistent=False)
 
         return user_similar_neighbors_mat, user_similar_neighbors_weights_mat, item_similar_neighbors_mat, item_similar_neighbors_weights_mat
 
@@ -530,99 +1168,53 @@ class HDCL(nn.Module):
         embeddings2 = data2[index]
         norm_embeddings1 = F.normalize(embeddings1, p=2, dim=1)
         norm_embeddings2 = F.normalize(embeddings2, p=2, dim=1)
-        pos_score = torch.sum(torch.mul(norm_embeddings1, norm_embeddings2), dim=1)
-        all_score = torch.mm(norm_embeddings1, norm_embeddings2.T)
-        pos_score = torch.exp(pos_score / 0.5)
-        all_score = torch.sum(torch.exp(all_score / 0.5), dim=1)
-        ssl_loss = (-torch.sum(torch.log(pos_score / ((all_score)))) / (len(index)))
+        ssl_loss = info_nce(norm_embeddings1, norm_embeddings2, norm_embeddings2, 0.5, self.ssl_chunk_size)
         return ssl_loss
 
-    def neighbor_sample(self, input_list, weight_list):
-        if len(input_list) == 1:  # 只有一个邻居可选，不需要进行采样
-            return input_list[0], weight_list[0]
-        else:
-            self.prob_sampling = True
-            if self.prob_sampling:  # 使用概率抽样
-                prob = np.asarray(weight_list).astype('float64')
-                prob = prob / sum(prob)
-                idx = np.random.choice(range(0, len(input_list)), size=1, replace=True, p=prob)
-                idx = idx.item()
-            else:
-                idx = np.random.randint(0, len(input_list))
-            return input_list[idx], weight_list[idx]
-
-    def calculate_ssl_loss(self, data1, data2, user, pos_item):
-        batch_user_weight = []
-        batch_item_weight = []
-
-        # batch_users_3 is used to index the user embedding from view-2
-        batch_users_3 = []
-        # batch_items_3 is used to index the user embedding from view-2
-        batch_items_3 = []
-
-        # batch_users_4 is used to index the user embedding from view-1
-        batch_users_4 = []
-        # batch_items_4 is used to index the user embedding from view-1
-        batch_items_4 = []
-
-        batch_nodes_list = []
-
+    def neighbor_sample(self, neighbors, weights, nodes):
+        """
+        为 nodes 中每个节点按相似度权重抽取一个 kNN 邻居 (一次 torch.multinomial 完成整批抽样).
+        返回 (邻居, 是否存在邻居的掩码)
+        """
+        node_weights = weights[nodes]
+        has_neighbor = node_weights[:, 0] > 0  # 邻居按相似度降序排列, 第一个为 0 说明没有邻居
+        node_weights = torch.where(has_neighbor.unsqueeze(1), node_weights, torch.ones_like(node_weights))
+        choice = torch.multinomial(node_weights, 1).squeeze(1)
+        return neighbors[nodes, choice], has_neighbor
+
+    @torch.no_grad()
+    def _ssl_neighbor_draws(self, user, pos_item):
+        # add user and her k-nearest neighbors positive pair
+        sample_user, has_user_neighbor = self.neighbor_sample(self.user_similar_neighbors,
+                                                              self.user_similar_weights, user)
+        # add item and its k-nearest neighbors positive pair
+        sample_item, has_item_neighbor = self.neighbor_sample(self.item_similar_neighbors,
+                                                              self.item_similar_weights, pos_item)
+        return sample_user, has_user_neighbor, sample_item, has_item_neighbor
+
+    def calculate_ssl_loss(self, data1, data2, user, pos_item, draws=None):
         with torch.no_grad():
-            batch_users_list = user.cpu().numpy().tolist()
             # update item ids to map the original item id to the constructed graph
-            batch_items_list = (pos_item + self.unum).cpu().numpy().tolist()
-
-            # batch_nodes_list stores both the batch_users_list and the batch_item_list
-            batch_nodes_list.extend(batch_users_list)
-            batch_nodes_list.extend(batch_items_list)
-
-            for idx, user in enumerate(batch_users_list):
-                # 两个视图的相同节点视为正样本
-                batch_user_weight.append(1.0)  # 1.0是权重值
-                batch_users_3.append(user)
-                batch_users_4.append(user)
-
-                # add user-item positive pair
-                item = batch_items_list[idx]
-                batch_user_weight.append(1.0)
-                batch_users_3.append(item)  # 加了一个训练的和user配对的正样本pos_item
-                batch_users_4.append(user)
-
-                # add user and her k-nearest neighbors positive pair
-                if self.user_similar_neighbors_mat[user].size != 0:  # 如果有可选的候选最近邻邻居
-                    sample_user, sample_weight = self.neighbor_sample(self.user_similar_neighbors_mat[user],
-                                                                      self.user_similar_neighbors_weights_mat[
-                                                                          user])
-                    batch_user_weight.append(1.0)  # 1.0
-                    batch_users_3.append(sample_user)  # 从中挑选一个最近邻居
-                    batch_users_4.append(user)
-
-            for idx, item in enumerate(batch_items_list):
-                batch_item_weight.append(1.0)
-                batch_items_3.append(item)
-                batch_items_4.append(item)
-
-                # add item-user positive pair
-                user = batch_users_list[idx]
-                batch_item_weight.append(1.0)
-                batch_items_3.append(user)
-                batch_items_4.append(item)
-
-                # # add item and its k-nearest neighbors positive pair
-                if self.item_similar_neighbors_mat[item - self.n_users].size != 0:
-                    sample_item, sample_weight = self.neighbor_sample(
-                        self.item_similar_neighbors_mat[item - self.n_users],
-                        self.item_similar_neighbors_weights_mat[item - self.n_users])
-                    sample_item += +self.n_users
-                    batch_item_weight.append(1.0)
-                    batch_items_3.append(sample_item)
-                    batch_items_4.append(item)
-
-            batch_users_3 = torch.tensor(batch_users_3).long().to(self.device)
-            batch_items_3 = torch.tensor(batch_items_3).long().to(self.device)
-            batch_users_4 = torch.tensor(batch_users_4).long().to(self.device)
-            batch_items_4 = torch.tensor(batch_items_4).long().to(self.device)
-            batch_nodes_list = torch.tensor(list(batch_nodes_list)).long().to(self.device)
+            item = pos_item + self.unum
+
+            # draws 为预先抽好的 kNN 邻居 (采样训练需要提前知道要用到的节点)
+            if draws is None:
+                draws = self._ssl_neighbor_draws(user, pos_item)
+            sample_user, has_user_neighbor, sample_item, has_item_neighbor = draws
+            sample_item = sample_item + self.n_users
+
+            # batch_users_3 is used to index the user embedding from view-2:
+            # 两个视图的相同节点、与 user 配对的正样本 pos_item、以及一个最近邻居都视为正样本
+            batch_users_3 = torch.cat([user, item, sample_user[has_user_neighbor]])
+            # batch_users_4 is used to index the user embedding from view-1
+            batch_users_4 = torch.cat([user, user, user[has_user_neighbor]])
+            # batch_items_3 is used to index the user embedding from view-2
+            batch_items_3 = torch.cat([item, user, sample_item[has_item_neighbor]])
+            # batch_items_4 is used to index the user embedding from view-1
+            batch_items_4 = torch.cat([item, item, item[has_item_neighbor]])
+
+            # batch_nodes_list stores both the batch users and the batch items
+            batch_nodes_list = torch.cat([user, item])
 
         # batch_users_3, batch_items_3 are consisf of different positive samples, get representations from view-1
         user_emb3 = data1[batch_users_3]
@@ -638,33 +1230,67 @@ class HDCL(nn.Module):
         emb_merge3 = torch.cat([user_emb3, item_emb3], dim=0)
         emb_merge4 = torch.cat([user_emb4, item_emb4], dim=0)
 
-        batch_weights = batch_user_weight + batch_item_weight
-        batch_weights = torch.tensor(batch_weights, dtype=torch.float32).to(self.device)
-
         # cosine similarity
         normalize_emb_merge3 = torch.nn.functional.normalize(emb_merge3, p=2, dim=1)
         normalize_emb_merge4 = torch.nn.functional.normalize(emb_merge4, p=2, dim=1)
         normalize_batch_node_emb = torch.nn.functional.normalize(batch_node_emb, p=2, dim=1)
 
-        # differeent kinds of positive samples from view-1 mutliply the anchor nodes' representations from view-2
-        pos_score = torch.sum(torch.multiply(normalize_emb_merge3, normalize_emb_merge4), dim=1)
-
-        # different kinds of positive samples from view-1 matmul the negative samples from view-2
-        ttl_score = torch.matmul(normalize_emb_merge3, normalize_batch_node_emb.transpose(0, 1))
-
-        pos_score = batch_weights * torch.exp(pos_score / self.ssl_temp)
-        ttl_score = torch.sum(torch.exp(ttl_score / self.ssl_temp), dim=1)
-        ssl_loss = -torch.mean(torch.log(pos_score / ttl_score))
+        # differeent kinds of positive samples from view-1 mutliply the anchor nodes' representations from view-2,
+        # and matmul the negative samples from view-2 (streamed in chunks of anchors)
+        negatives = normalize_batch_node_emb
+        if self.ssl_queue_size > 0:
+            # 队列中最近若干 batch 的 view-2 嵌入作为额外负样本
+            if self.ssl_queue is not None and self.ssl_queue_filled > 0:
+                negatives = torch.cat([negatives, self.ssl_queue[:self.ssl_queue_filled]], dim=0)
+            if self.training:
+                self._enqueue_negatives(normalize_batch_node_emb.detach())
+        ssl_loss = info_nce(normalize_emb_merge3, normalize_emb_merge4, negatives, self.ssl_temp,
+                            self.ssl_chunk_size)
 
         return ssl_loss
 
+    @torch.no_grad()
+    def _enqueue_negatives(self, embeddings):
+        """把已归一化、detach 的嵌入写入环形队列, 覆盖最旧的条目"""
+        if self.ssl_queue is None:
+            self.ssl_queue = embeddings.new_zeros(self.ssl_queue_size, embeddings.shape[1])
+        embeddings = embeddings[-self.ssl_queue_size:]
+        index = (self.ssl_queue_ptr + torch.arange(len(embeddings), device=embeddings.device)) % self.ssl_queue_size
+        self.ssl_queue[index] = embeddings
+        self.ssl_queue_ptr = (self.ssl_queue_ptr + len(embeddings)) % self.ssl_queue_size
+        self.ssl_queue_filled = min(self.ssl_queue_filled + len(embeddings), self.ssl_queue_size)
+
     def alignment(self, x, y):
         x, y = F.normalize(x, dim=-1), F.normalize(y, dim=-1)
         return (x - y).norm(p=2, dim=1).pow(2).mean()
 
+    @staticmethod
+    def _uniformity_block(x_block, x, start):
+        """一块 anchor 与全部点的 -2 * ||xi - xj||^2 (单位向量下为 4 xi.xj - 4), 去掉 i == j 后按行 logsumexp"""
+        score = torch.mm(x_block, x.t()).mul(4).sub(4)
+        diagonal = torch.arange(len(x_block), device=x.device)
+        score[diagonal, diagonal + start] = float('-inf')
+        return torch.logsumexp(score, dim=1)
+
     def uniformity(self, x):
+        """
+        log(mean_{i != j} exp(-2 * ||xi - xj||^2)):
+            pdist:   原始实现, 构造全部 B(B-1)/2 个距离
+            exact:   分块 log-sum-exp, 反向时逐块重算, 显存 O(chunk * B)
+            sampled: 只用 uniformity_pairs 个随机点对估计, 显存 O(pairs)
+        """
         x = F.normalize(x, dim=-1)
-        return torch.pdist(x, p=2).pow(2).mul(-2).exp().mean().log()
+        n = len(x)
+        # 少于两个点时没有点对, 与原始实现一样返回 NaN
+        if self.uniformity_mode == 'pdist' or n < 2:
+            return torch.pdist(x, p=2).pow(2).mul(-2).exp().mean().log()
+        if self.uniformity_mode == 'sampled':
+            i = torch.randint(n, (self.uniformity_pairs,), device=x.device)
+            j = (i + torch.randint(1, n, (self.uniformity_pairs,), device=x.device)) % n
+            return (x[i] - x[j]).pow(2).sum(dim=1).mul(-2).exp().mean().log()
+        row_lse = torch.cat([checkpoint(self._uniformity_block, x[start:start + self.ssl_chunk_size], x, start,
+                                        use_reentrant=False) for start in range(0, n, self.ssl_chunk_size)])
+        return torch.logsumexp(row_lse, dim=0) - math.log(n * (n - 1))
 
     def calculate_loss(self, user_e, item_e):
         # user_e, item_e = self.encoder(user, item)  # [bsz, dim]
@@ -672,27 +1298,96 @@ class HDCL(nn.Module):
         uniform = (self.uniformity(user_e) + self.uniformity(item_e)) / 2
         return align, uniform
 
+    def _sampled_han(self, key, nodes):
+        """只为 nodes 计算元路径分支的表示, 写入全零的 [N, D] 表中, 其余行不参与损失"""
+        nodes = torch.unique(nodes)
+        h = self.feature_dict[key]
+        out = self.hans[key].forward_sampled(self.g, h, nodes, self.han_layers)
+        return out.new_zeros(h.shape[0], out.shape[1]).index_copy(0, nodes, out)
+
+    def embedding_tables(self):
+        """按节点索引的嵌入表 (feature_dict 与 LightGCN 初始嵌入), 可用行稀疏的优化器更新"""
+        return list(self.feature_dict.values()) + [self.LightGCN.initial_embeddings]
+
+    def reset_history(self):
+        """丢弃缓存的历史传播结果, 下一个训练步重新传播"""
+        self._history_age = None
+        self.LightGCN.reset_history()
+        for han in self.hans.values():
+            han.reset_history()
+
+    def _history_live_nodes(self, user_idx, item_idx, neg_item_idx, draws, car_nodes):
+        """使用历史嵌入时本步损失读取的用户/物品 (不含 full 模式的 CAR 节点, 它们只经自身项求导)"""
+        users = [user_idx, draws[0][draws[1]]]
+        items = [item_idx, neg_item_idx, draws[2][draws[3]]]
+        if self.car_mode != 'full':
+            users += [car_nodes[('user', part)][0] for part in ('head', 'tail')]
+            items += [car_nodes[('item', part)][0] for part in ('head', 'tail')]
+        return {self.user_key: torch.unique(torch.cat(users)), self.item_key: torch.unique(torch.cat(items))}
+
+    def _history_refresh(self):
+        """返回本步是否刷新历史嵌入; 未启用时返回 None"""
+        if self.history_interval == 0 or not self.training:
+            return None
+        refresh = self._history_age is None or 0 < self.history_interval <= self._history_age
+        self._history_age = 1 if refresh else self._history_age + 1
+        return refresh
+
     def forward(self, user_idx, item_idx, neg_item_idx):
-        ua_embedding, ia_embedding, ua_embedding1, ia_embedding1,ua_embedding2, ia_embedding2,int_embeddings = self.LightGCN(self.feature_dict)
+        refresh_history = self._history_refresh()
+        draws, car_nodes, live_nodes = None, None, {}
+        if (self.han_sampled or refresh_history is not None) and self.training:
+            # 先抽出本步会读取的全部节点 (batch, kNN 正样本, CAR 节点), HAN 只在它们的感受野上运行
+            draws = self._ssl_neighbor_draws(user_idx, item_idx)
+            car_nodes = self._draw_car_nodes(user_idx, item_idx)
+        if refresh_history is not None:
+            live_nodes = self._history_live_nodes(user_idx, item_idx, neg_item_idx, draws, car_nodes)
+        lightgcn_nodes = None
+        if live_nodes:
+            lightgcn_nodes = torch.cat([live_nodes[self.user_key], live_nodes[self.item_key] + self.n_users])
+        ua_embedding, ia_embedding, ua_embedding1, ia_embedding1,ua_embedding2, ia_embedding2,int_embeddings = self.LightGCN(self.feature_dict, refresh_history, lightgcn_nodes)
         # metapath-based aggregation, h2
         h2 = {}
-        for key in self.meta_path_patterns.keys():
-            for i in range(self.han_layers):
-                if i == 0:
-                    h2[key] = self.hans[key](self.g, self.feature_dict[key])
-                else:
-                    h2[key] = self.hans[key](self.g, h2[key])
+        if self.han_sampled and self.training:
+            seeds = {self.user_key: [user_idx, draws[0][draws[1]], car_nodes[('user', 'head')][0],
+                                     car_nodes[('user', 'tail')][0]],
+                     self.item_key: [item_idx, neg_item_idx, car_nodes[('item', 'head')][0],
+                                     car_nodes[('item', 'tail')][0]]}
+            if self.han_attention_interval > 0:
+                if self._attention_age is None or self._attention_age >= self.han_attention_interval:
+                    for key in self.meta_path_patterns.keys():
+                        self.hans[key].refresh_population_scores(self.g, self.feature_dict[key], self.han_layers)
+                    self._attention_age = 0
+                self._attention_age += 1
+            for key in self.meta_path_patterns.keys():
+                h2[key] = self._sampled_han(key, torch.cat(seeds[key]))
+        else:
+            # 启用历史嵌入时每层的邻居聚合各自缓存在 slot i 下
+            history_slot = None
+            for key in self.meta_path_patterns.keys():
+                for i in range(self.han_layers):
+                    if refresh_history is not None:
+                        history_slot = i
+                    if i == 0:
+                        h2[key] = self.hans[key](self.g, self.feature_dict[key], history_slot, bool(refresh_history),
+                                                 live_nodes.get(key))
+                    else:
+                        h2[key] = self.hans[key](self.g, h2[key], history_slot, bool(refresh_history),
+                                                 live_nodes.get(key))
         user_emb = 0.5 * ua_embedding + 0.5 * h2[self.user_key]
         item_emb = 0.5 * ia_embedding + 0.5 * h2[self.item_key]
+        if self.recluster_interval > 0 and not self._recluster_from_inference():
+            self._last_fused_embeddings = (user_emb.detach(), item_emb.detach())
 
-        car_loss = self._cluster_anchor_regularization(ua_embedding, ia_embedding, h2)
+        car_loss = self._cluster_anchor_regularization(ua_embedding, ia_embedding, h2, user_idx, item_idx,
+                                                       car_nodes)
         # 计算对比损失
         # ssl_loss_user = self.ssl_loss(ua_embedding1, ua_embedding2, user_idx)
         # ssl_loss_item = self.ssl_loss(ia_embedding1, ia_embedding2, item_idx)
         # ssl_loss = ssl_loss_user + ssl_loss_item
         data1 = torch.cat((h2[self.user_key], h2[self.item_key]), dim=0)
         data2 = torch.cat((ua_embedding, ia_embedding), dim=0)
-        ssl_loss = self.calculate_ssl_loss(data1, data2, user_idx, item_idx)
+        ssl_loss = self.calculate_ssl_loss(data1, data2, user_idx, item_idx, draws)
 
         user_e3 = ua_embedding1[user_idx]
         item_e3 = ia_embedding1[item_idx]
@@ -739,27 +1434,42 @@ class HDCL(nn.Module):
         loss += car_loss
         return loss, reg_loss
 
+    def _parameter_versions(self):
+        return tuple(param._version for param in self.parameters())
+
+    def train(self, mode=True):
+        self._inference_cache = None
+        return super(HDCL, self).train(mode)
+
+    @torch.no_grad()
+    def get_inference_embeddings(self):
+        """
+        计算一次融合后的用户/物品嵌入表并缓存, 参数被优化器原地更新(版本号变化)或切换到训练模式时失效.
+        推理路径不生成扰动视图.
+        """
+        versions = self._parameter_versions()
+        if self._inference_cache is None or self._inference_cache[0] != versions:
+            ua_embedding, ia_embedding = self.LightGCN.inference()
+            # metapath-based aggregation, h2
+            h2 = {}
+            for key in self.meta_path_patterns.keys():
+                for i in range(self.han_layers):
+                    if i == 0:
+                        h2[key] = self.hans[key](self.g, self.feature_dict[key])
+                    else:
+                        h2[key] = self.hans[key](self.g, h2[key])
+            user_emb = 0.5 * ua_embedding + 0.5 * h2[self.user_key]
+            item_emb = 0.5 * ia_embedding + 0.5 * h2[self.item_key]
+            self._inference_cache = (versions, user_emb, item_emb)
+        return self._inference_cache[1], self._inference_cache[2]
+
     def predict(self, user_idx, item_idx):
-        ua_embedding, ia_embedding, ua_embedding1, ia_embedding1,ua_embedding2, ia_embedding2,int_embeddings = self.LightGCN(self.feature_dict)
-        # metapath-based aggregation, h2
-        h2 = {}
-        for key in self.meta_path_patterns.keys():
-            for i in range(self.han_layers):
-                if i == 0:
-                    h2[key] = self.hans[key](self.g, self.feature_dict[key])
-                else:
-                    h2[key] = self.hans[key](self.g, h2[key])
-        user_emb = 0.5 * ua_embedding + 0.5 * h2[self.user_key]
-        item_emb = 0.5 * ia_embedding + 0.5 * h2[self.item_key]
+        user_emb, item_emb = self.get_inference_embeddings()
         user_emb = user_emb[user_idx]
         item_emb = item_emb[item_idx]
         return user_emb, item_emb
 
     def getUsersRating(self, user_idx):
-        # x = [2742, 2741, 2743, 2700, 1192, 1976, 2736, 2740, 1201, 2744, 2745, 2739, 2731, 2738, 2161, 1262, 2737, 2722, 2734, 2735, 2733, 2721, 2706, 2729, 849, 2712, 1850, 2732, 2707, 2704, 1853, 2117, 2724, 2551, 2730, 1564, 2726, 2728, 2695, 2727, 2664, 2599, 2718, 2442, 2313, 2716, 2717, 2725, 2554, 2711, 2008, 992, 2698, 2182, 2345, 2713, 2714, 2723, 2719, 2720, 2479, 1430, 1150, 2414, 2642, 2088, 2709, 2648, 1500, 2692, 1436, 2708, 1506, 2701, 2686, 2673, 2705, 2703, 2687, 2267, 2715, 2048, 2689, 2694, 1677, 2683, 2377, 2697, 2702, 2578, 2336, 2489, 2639, 2587, 2688, 2545, 1649, 2653, 2699, 2512, 1018, 2640, 2690, 2107, 2710, 2691, 2669, 2693, 2620, 1719, 2696, 2408, 955, 2649, 1562, 2556, 2362, 1985, 2591, 2680, 1683, 2630, 2681, 2657, 2580, 2679, 2656, 2662, 2607, 2666, 2563, 2651, 2081, 2349, 2685, 2016, 2530, 2558, 2590, 2561, 2627, 2598, 2568, 2663, 2670, 2629, 2575, 2634, 2233, 2659, 2674, 2661, 2641, 2007, 2684, 2402, 1639, 2463, 2682, 2611, 1909, 2660, 1561, 2515, 2595, 2610, 2672, 2645, 2608, 2559, 2652, 2644, 2625, 2617, 2021, 2542, 2655, 2577, 2084, 2643, 1970, 2204, 1676, 2677, 2675, 1442, 2667, 2537, 2628, 2564, 2678, 2613, 1739, 2668, 2658, 2571, 2472, 2676, 2291, 2671, 2665, 2363, 2650, 2635, 1765, 2633, 1779, 2654, 2626, 2615, 2536, 2612, 2525, 2583, 2404, 2400, 2355, 2462, 1937, 2597, 2394, 2570, 2114, 1913, 2356, 2535, 2227, 2621, 2500, 2623, 1299, 2549, 2526, 2646, 1941, 2543, 2596, 2637, 2619, 2638, 2647, 2636, 1174, 2322, 1959, 2170, 1998, 1761, 2293, 2309, 2506, 2268, 2533, 2609, 2490, 2453, 2518, 2366, 2631, 2465, 2602, 2552, 2112, 2352, 2508, 1778, 2614, 1942, 2565, 2624, 1139, 2517, 2606, 2632, 2532, 2138, 2585, 2576, 2618, 2569, 623, 2592, 1245, 2546, 2418, 2622, 2398, 2566, 2616, 2399, 2303, 2338, 1843, 2498, 2514, 2604, 2544, 2448, 2494, 2521, 2478, 930, 2510, 1431, 2409, 2340, 1701, 2555, 2531, 2053, 2522, 2593, 1999, 2105, 2579, 2605, 2449, 2254, 2573, 1588, 2594, 2428, 2452, 2547, 2288, 2553, 2589, 2603, 789, 2523, 1284, 2513, 2135, 2401, 2422, 2582, 2475, 2455, 2492, 843, 1980, 2601, 2541, 2502, 2534, 2213, 2371, 2421, 1965, 2025, 2341, 2295, 1468, 1709, 2560, 2183, 1784, 2314, 2483, 2332, 2420, 2069, 2600, 2180, 2493, 1911, 2584, 2586, 2567, 2588, 2562, 2486, 2347, 2003, 2574, 1990, 2389, 2528, 1275, 1364, 2343, 986, 2524, 2124, 2225, 1242, 2440, 2519, 2415, 2230, 2459, 2250, 2456, 2507, 2433, 2488, 2447, 1809, 2368, 2328, 2405, 2464, 2264, 2503, 2477, 1944, 2384, 2481, 1225, 2520, 2429, 2550, 2473, 1629, 2581, 2424, 2470, 1573, 2548, 1859, 2540, 2538, 2557, 2572, 2294, 1489, 2485, 2484, 2058, 2393, 2443, 2375, 1993, 1953, 2504, 2509, 2511, 2416, 2219, 2299, 2330, 2191, 2457, 2487, 2496, 2495, 2132, 2317, 2407, 1664, 2411, 2430, 2469, 2235, 2306, 1805, 1714, 1700, 2278, 2396, 2461, 2539, 2505, 2256, 2527, 2412, 2207, 1600, 760, 2480, 2381, 2427, 2529, 1735, 2392, 2410, 2186, 1710, 1545, 2413, 944, 2397, 1791, 1974, 2296, 2499, 1625, 2323, 2361, 2467, 2279, 2497, 1637, 2282, 2284, 1617, 2026, 2491, 1493, 1247, 1813, 2471, 2458, 2441, 1394, 1910, 2450, 2468, 2175, 2210, 2325, 2376, 2426, 2027, 2445, 1380, 2482, 2344, 2516, 1323, 2247, 1295, 2476, 432, 2331, 1713, 1628, 2231, 2029, 1962, 2333, 2111, 2365, 2451, 2252, 2241, 2312, 2310, 2370, 2301, 2438, 2185, 2228, 1772, 2382, 2251, 2197, 2168, 2041]
-        # item_idx = torch.Tensor(x).long().to(self.device)
-        item_idx = torch.Tensor(np.arange(self.inum)).long().to(self.device)
-        # users_emb, all_items, _ = self.forward(user_idx, item_idx, None)
-        users_emb, all_items = self.predict(user_idx, item_idx)
-        rating = torch.matmul(users_emb, all_items.t())
+        user_emb, item_emb = self.get_inference_embeddings()
+        rating = torch.matmul(user_emb[user_idx.to(user_emb.device)], item_emb.t())
         return rating
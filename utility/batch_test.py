@@ -60,7 +60,7 @@ def Test(dataset: Data, model, device, topK, flag_multicore, test_batch_size, lo
                      'HR': np.zeros(len(topK)),
                      'ndcg': np.zeros(len(topK))}
     with torch.no_grad():
-        users = list(dataset.test_dict.keys())  # get user list to test
+        users = dataset.test_dict.keys()  # get user list to test
         # if test_batch_size > len(users) // 10:
         #     print(f"\tTest batch size is too big for dataset, please try a small one {len(users) // 10}")
         users_list, rating_list, ground_true_list = [], [], []
@@ -69,13 +69,12 @@ def Test(dataset: Data, model, device, topK, flag_multicore, test_batch_size, lo
         # num_batch = 1
         long_tail_rate = 0.
         for batch_users in mini_batch(users, batch_size=test_batch_size):
-            exclude_users, exclude_items = [], []
-            all_positive = dataset.get_user_pos_items(batch_users)
+            exclude_users, exclude_items = dataset.all_positive.gather(batch_users)
             ground_true = [dataset.test_dict[u] for u in batch_users]
 
             # batch_auxiliary, auxiliary_score = dataset.get_user_simi_users(batch_users)
             # item_batch_device = torch.Tensor(item_batch).long().to(device)
-            batch_users_device = torch.Tensor(batch_users).long()#.to(device)
+            batch_users_device = torch.from_numpy(batch_users).long()#.to(device)
             #             batch_auxiliary_device = torch.Tensor(batch_auxiliary).long().to(device)
             #             auxiliary_score_device = torch.FloatTensor(auxiliary_score).to(device)
             # u_g_embeddings, pos_i_g_embeddings = SGL(batch_users_device, item_batch_device, [], feature_dict, mode='test')
@@ -83,10 +82,7 @@ def Test(dataset: Data, model, device, topK, flag_multicore, test_batch_size, lo
             # rating = SGL.get_rating_for_test(batch_users_device, item_batch_device)
 
             # Positive items are excluded from the recommended list
-            for i, items in enumerate(all_positive):
-                exclude_users.extend([i] * len(items))
-                exclude_items.extend(items)
-            rating[exclude_users, exclude_items] = -1
+            rating[torch.from_numpy(exclude_users), torch.from_numpy(exclude_items).long()] = -1
 
             # get the top-K recommended list for all users
             _, rating_k = torch.topk(rating, k=max(topK))
@@ -165,8 +161,7 @@ def Test_sparsity(dataset: Data, model, device, topK, test_batch_size):
             num_batch = len(users) // test_batch_size + 1
 
             for batch_users in mini_batch(users, batch_size=test_batch_size):
-                exclude_users, exclude_items = [], []
-                all_positive = dataset.get_user_pos_items(batch_users)
+                exclude_users, exclude_items = dataset.all_positive.gather(batch_users)
                 ground_true = [dataset.test_dict[u] for u in batch_users]
 
                 batch_users_device = torch.Tensor(batch_users).long().to(device)
@@ -174,11 +169,7 @@ def Test_sparsity(dataset: Data, model, device, topK, test_batch_size):
                 rating = model.getUsersRating(batch_users_device).detach().cpu()
 
                 # Positive items are excluded from the recommended list
-                for i, items in enumerate(all_positive):
-                    exclude_users.extend([i] * len(items))
-                    exclude_items.extend(items)
-
-                rating[exclude_users, exclude_items] = -1
+                rating[torch.from_numpy(exclude_users), torch.from_numpy(exclude_items).long()] = -1
 
                 # get the top-K recommended list for all users
                 _, rating_k = torch.topk(rating, k=max(topK))
@@ -1,12 +1,62 @@
 import numpy as np
 import os
+import hashlib
 import scipy.sparse as sp
 import tqdm
 import warnings
+from utility.sampler import NegativeSampler
 
 warnings.filterwarnings('ignore')
 
 
+class CSRIndex(object):
+    def __init__(self, indptr, indices):
+        """
+            以 CSR (indptr/indices, int32) 形式存储每行(用户)对应的物品列表,
+            兼容原先 list/dict 风格的按用户访问: index[user], index.get(user), index.keys()
+        """
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.lengths = np.diff(self.indptr)
+
+    @classmethod
+    def from_pairs(cls, rows, cols, num_rows):
+        """ 由 (row, col) 交互对构建, 同一行内保持原有顺序 """
+        rows = np.asarray(rows, dtype=np.int64)
+        order = np.argsort(rows, kind="stable")
+        indptr = np.zeros(num_rows + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=num_rows))
+        return cls(indptr, np.asarray(cols)[order])
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, row):
+        return self.indices[self.indptr[row]:self.indptr[row + 1]]
+
+    def __contains__(self, row):
+        return 0 <= row < len(self.lengths) and self.lengths[row] > 0
+
+    def get(self, row, default=None):
+        return self[row] if row in self else default
+
+    def keys(self):
+        """ 非空行的编号 """
+        return np.flatnonzero(self.lengths)
+
+    def gather(self, rows):
+        """
+            批量取出多行: 返回 (batch_pos, indices), batch_pos[k] 为 indices[k] 所在行在 rows 中的位置,
+            可直接用于 rating[batch_pos, indices] 的索引
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.indptr[rows].astype(np.int64)
+        lengths = self.lengths[rows].astype(np.int64)
+        batch_pos = np.repeat(np.arange(len(rows)), lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return batch_pos, self.indices[np.repeat(starts, lengths) + offsets]
+
+
 class Data(object):
     def __init__(self, path):
         self.path = path
@@ -28,6 +78,7 @@ class Data(object):
         self.user_item_net = None
         self.all_positive = None
         self.test_dict = None
+        self.sampler = None
         self.similarity_list = dict()
         self.load_data()
         self.noise = 1
@@ -47,8 +98,8 @@ class Data(object):
         test_user, self.test_user, self.test_item, self.num_test, _ = self.read_ratings(test_path)
         print("\t\tTest dataset loading completed.")
         print("\tTrain and test dataset loading completed.")
-        self.num_users = max(train_user)
-        self.num_items = max(self.train_item)
+        self.num_users = int(train_user.max())
+        self.num_items = int(self.train_item.max())
         """ 因为索引是从 0 计数，所以 +1 """
         self.num_users += 1
         self.num_items += 1
@@ -83,8 +134,10 @@ class Data(object):
         # self.sparse_adjacency_matrix()
         # self.read_similarity_user_list(self.path + "/simi.txt")
 
-        self.all_positive = self.get_user_pos_items(list(range(self.num_users)))
+        self.user_item_net.sort_indices()
+        self.all_positive = CSRIndex(self.user_item_net.indptr, self.user_item_net.indices)
         self.test_dict = self.build_test()
+        self.sampler = NegativeSampler(self.user_item_net)
 
     #         self.split_test_dict, self.split_state = self.create_sparsity_split()
 
@@ -154,33 +207,60 @@ class Data(object):
                 inter_num: 记录 item 总数, 810128
                 pos_length: 分别记录每个 userID 交互的物品总数量, [127, 49, ...], 29858
 
-                user_id: 循环变量，记录当前 userID
-                pos_id: 循环变量，记录当前 userID 交互的各个 itemID
+            解析结果以 .npy 形式缓存在 <file_name>.cache/ 下, 以文本内容的哈希校验,
+            文本改变时自动重建; 命中缓存时以 mmap 方式加载
         """
-        inter_users, inter_items, unique_users = [], [], []
-        inter_num = 0
-        pos_length = []
-        with open(file_name, "r") as f:
-            line = f.readline()
-            while line is not None and line != "":
-                temp = line.strip()
-                arr = [int(i) for i in temp.split(" ")]
-                user_id, pos_id = arr[0], arr[1:]
-                unique_users.append(user_id)
-
-                # if len(pos_id) < 1:
-                #     print(user_id, pos_id)
-                #     break
-                # self.num_users = max(self.num_users, user_id)
-                # self.num_items = max(self.num_items, max(pos_id))
-
-                inter_users.extend([user_id] * len(pos_id))
-                pos_length.append(len(pos_id))
-                inter_items.extend(pos_id)
-                inter_num += len(pos_id)
-                line = f.readline()
-
-        return np.array(unique_users), np.array(inter_users), np.array(inter_items), inter_num, pos_length
+        with open(file_name, "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha1(raw).hexdigest()
+        cache_dir = file_name + ".cache"
+        names = ["unique_users", "inter_users", "inter_items", "pos_length"]
+        try:
+            with open(os.path.join(cache_dir, "hash.txt"), "r") as f:
+                cached_digest = f.read().strip()
+            if cached_digest != digest:
+                raise ValueError("stale cache")
+            arrays = [np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode="r") for name in names]
+        except (OSError, ValueError):
+            arrays = self.parse_ratings(raw)
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                for name, array in zip(names, arrays):
+                    tmp_name = os.path.join(cache_dir, name + ".tmp.npy")
+                    np.save(tmp_name, array)
+                    os.replace(tmp_name, os.path.join(cache_dir, name + ".npy"))
+                # 哈希最后写入, 保证缓存完整后才生效
+                with open(os.path.join(cache_dir, "hash.txt"), "w") as f:
+                    f.write(digest)
+            except OSError:
+                print("\t\tWarning: failed to write rating cache to", cache_dir)
+        unique_users, inter_users, inter_items, pos_length = arrays
+
+        return unique_users, inter_users, inter_items, len(inter_items), pos_length
+
+    @staticmethod
+    def parse_ratings(raw):
+        """ 向量化解析 "user item item ..." 格式的文本, raw 为文件的 bytes 内容 """
+        values = np.fromstring(raw.decode(), dtype=np.int64, sep=" ")
+        # 每行的 token 数: 统计每行中 token 的起始位置
+        buffer = np.frombuffer(raw, dtype=np.uint8)
+        is_space = np.isin(buffer, np.frombuffer(b" \t\r\n", dtype=np.uint8))
+        token_start = ~is_space
+        token_start[1:] &= is_space[:-1]
+        line_id = np.cumsum(buffer == ord("\n")) - (buffer == ord("\n"))
+        line_length = np.bincount(line_id[token_start], minlength=line_id[-1] + 1 if len(line_id) else 0)
+        line_length = line_length[line_length > 0]
+        assert line_length.sum() == len(values)
+
+        line_start = np.cumsum(line_length) - line_length
+        unique_users = values[line_start]
+        pos_length = line_length - 1
+        item_mask = np.ones(len(values), dtype=bool)
+        item_mask[line_start] = False
+        inter_items = values[item_mask]
+        inter_users = np.repeat(unique_users, pos_length)
+
+        return unique_users, inter_users, inter_items, pos_length
 
     def data_statistics(self):
         """ 输出读取数据的基本信息 """
@@ -294,30 +374,15 @@ class Data(object):
         norm_adjacency = degree_matrix.dot(adjacency_matrix).dot(degree_matrix).tocsr()
         return norm_adjacency
 
-    def sample_data_to_train_all(self):
-        users = np.random.randint(0, self.num_users, len(self.train_user))
-        sample_list = []
-        for i, user in enumerate(users):
-            positive_items = self.all_positive[user]
-            if len(positive_items) == 0:
-                continue
-            positive_index = np.random.randint(0, len(positive_items))
-            positive_item = positive_items[positive_index]
-            while True:
-                negative_item = np.random.randint(0, self.num_items)
-                if negative_item in positive_items:
-                    continue
-                else:
-                    break
-            sample_list.append([user, positive_item, negative_item])
-
-        return np.array(sample_list)
+    def sample_data_to_train_all(self, mode='random', rng=None):
+        """
+            一次性采样整个 epoch 的 (user, pos_item, neg_item) 三元组, 返回 int64 的 [n, 3] 数组
+            mode: 'random' 均匀采样用户; 'epoch' 每个训练交互恰好访问一次
+        """
+        return self.sampler.sample(mode, rng)
 
     def get_user_pos_items(self, users):
-        positive_items = []
-        for user in users:
-            positive_items.append(self.user_item_net[user].nonzero()[1])
-        return positive_items
+        return [self.all_positive[user] for user in users]
 
     def get_user_simi_users(self, users):
         simi_users, simi_scores = [], []
@@ -327,14 +392,8 @@ class Data(object):
         return simi_users, simi_scores
 
     def build_test(self):
-        test_data = {}
-        for i, item in enumerate(self.test_item):
-            user = self.test_user[i]
-            if test_data.get(user):
-                test_data[user].append(item)
-            else:
-                test_data[user] = [item]
-        return test_data
+        num_rows = max(self.num_users, int(self.test_user.max()) + 1 if len(self.test_user) else 0)
+        return CSRIndex.from_pairs(self.test_user, self.test_item, num_rows)
 
     def read_similarity_user_list(self, file_name):
         if os.path.exists(file_name):
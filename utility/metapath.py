@@ -0,0 +1,148 @@
+import os
+import hashlib
+import numpy as np
+import scipy.sparse as sp
+from concurrent.futures import ThreadPoolExecutor
+
+
+def graph_digest(g):
+    """SHA-1 of the node counts and the edge lists of every relation of a heterograph."""
+    digest = hashlib.sha1()
+    for ntype in g.ntypes:
+        digest.update("{}:{};".format(ntype, g.num_nodes(ntype)).encode())
+    for canonical_etype in sorted(g.canonical_etypes):
+        src, dst = g.edges(etype=canonical_etype)
+        digest.update(repr(canonical_etype).encode())
+        digest.update(src.cpu().numpy().astype(np.int64).tobytes())
+        digest.update(dst.cpu().numpy().astype(np.int64).tobytes())
+    return digest.hexdigest()
+
+
+def row_topk(matrix, topk, rng=None):
+    """Keeps the ``topk`` largest entries of every row of a CSR matrix, ties broken by ``rng`` (by column id if None)."""
+    matrix = matrix.tocsr()
+    matrix.sort_indices()
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    # 同一城市等情况下大量得分相同, 按编号截断会让所有节点保留同一批低编号邻居
+    ties = np.arange(matrix.nnz) if rng is None else rng.random(matrix.nnz)
+    order = np.lexsort((ties, -matrix.data, rows))
+    counts = np.diff(matrix.indptr)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - np.repeat(matrix.indptr[:-1], counts)
+    keep = rank < topk
+    return sp.csr_matrix((matrix.data[keep], (rows[keep], matrix.indices[keep])), shape=matrix.shape)
+
+
+def _chain_product(first_rows, factors, topk=0, seed=0, start=0):
+    product = first_rows
+    for factor in factors:
+        product = product @ factor
+    product = product.tocsr()
+    full_nnz = product.nnz
+    if topk > 0:
+        # 逐块截断, 完整的稠密可达图不会同时驻留内存
+        product = row_topk(product, topk, np.random.default_rng([seed, start]))
+    return product, full_nnz
+
+
+def metapath_adjacency(g, metapath, n_threads=1, block_size=4096, topk=0, score='count', seed=0):
+    r"""Path-count matrix of a metapath, the product of the adjacency of its relations.
+
+    The rows of the first relation are split into blocks whose chain products run in a thread pool,
+    scipy's sparse kernels release the GIL so the blocks are computed in parallel.
+
+    Args:
+        g (dgl.DGLHeteroGraph): The heterogeneous graph.
+        metapath (tuple): Relation names, e.g. ``('bc', 'cb')``.
+        n_threads (int): Number of threads, 1 computes in the current thread.
+        block_size (int): Rows of the first relation per task.
+        topk (int): If > 0 every node keeps only its ``topk`` highest scored metapath neighbors.
+        score (str): 'count' ranks neighbors by path count, 'random_walk' by the probability of reaching
+            them with a random walk along the metapath (row-normalized relations), which discounts paths
+            through high-degree intermediate nodes such as a large city.
+        seed (int): Seed of the random tie breaking among equally scored neighbors, every row block draws
+            from its own stream so the result does not depend on ``n_threads``.
+
+    Returns:
+        scipy.sparse.csr_matrix: [n_src, n_dst] float32 matrix of path counts (or walk probabilities).
+            When sparsified, row ``i`` of the transposed result holds the kept neighbors of ``i``, so that
+            every node aggregates from at most ``topk`` of them.
+        int: Number of edges of the full reachable graph.
+    """
+    factors = [g.adj_external(ctx='cpu', scipy_fmt='csr', etype=etype).astype(np.float32) for etype in metapath]
+    if score == 'random_walk':
+        factors = [sp.diags(1. / np.maximum(np.asarray(factor.sum(axis=1)).ravel(), 1.)).astype(np.float32) @ factor
+                   for factor in factors]
+    elif score != 'count':
+        raise NotImplementedError("Make sure 'score' in ['count', 'random_walk']!")
+    first, rest = factors[0].tocsr(), factors[1:]
+    starts = range(0, first.shape[0], block_size)
+    if n_threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(min(n_threads, len(starts))) as pool:
+            blocks = list(pool.map(lambda start: _chain_product(first[start:start + block_size], rest, topk, seed,
+                                                                start), starts))
+    else:
+        blocks = [_chain_product(first[start:start + block_size], rest, topk, seed, start) for start in starts]
+    product = sp.vstack([block[0] for block in blocks], format='csr') if len(blocks) > 1 else blocks[0][0]
+    if topk > 0:
+        product = product.T.tocsr()
+    product.sum_duplicates()
+    product.sort_indices()
+    return product, sum(block[1] for block in blocks)
+
+
+def metapath_name(metapath):
+    return "-".join(metapath)
+
+
+def load_metapath_adjacencies(g, metapaths, cache_dir=None, n_threads=1, topk=0, score='count', seed=0):
+    r"""Path-count matrices of several metapaths, read from or written to ``cache_dir``.
+
+    Every matrix is stored as ``<sha1(graph digest, metapath, topk, score, seed)>.npz``, so a changed graph,
+    metapath or sparsification simply misses the cache. Files are written to a temporary name first and
+    renamed once complete. The edge counts before and after sparsification are printed per metapath.
+
+    Args:
+        topk (int or dict): Neighbors kept per node, either for all metapaths or per metapath name such as
+            ``{'bc-cb': 50}``; 0 or a missing name keeps the full reachable graph.
+        score (str): Ranking used by the top-k selection, see ``metapath_adjacency``.
+        seed (int): Seed of the top-k tie breaking.
+
+    Returns:
+        dict: metapath tuple -> scipy.sparse.csr_matrix path counts.
+    """
+    digest = graph_digest(g) if cache_dir is not None else None
+    adjacencies = {}
+    for metapath in metapaths:
+        metapath = tuple(metapath)
+        k = topk.get(metapath_name(metapath), 0) if isinstance(topk, dict) else topk
+        cache_file = None
+        adjacency = None
+        if cache_dir is not None:
+            key = repr(metapath) if k <= 0 else repr((metapath, k, score, seed))
+            cache_file = os.path.join(cache_dir, hashlib.sha1((digest + key).encode()).hexdigest() + ".npz")
+            try:
+                with np.load(cache_file) as cached:
+                    adjacency = sp.csr_matrix((cached["data"], cached["indices"], cached["indptr"]),
+                                              shape=tuple(cached["shape"]))
+                    full_nnz = int(cached["full_nnz"])
+            except (OSError, ValueError, KeyError):
+                adjacency = None
+        if adjacency is None:
+            adjacency, full_nnz = metapath_adjacency(g, metapath, n_threads, topk=k, score=score, seed=seed)
+            if cache_file is not None:
+                try:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    tmp_file = cache_file[:-len(".npz")] + ".tmp.npz"
+                    np.savez(tmp_file, data=adjacency.data, indices=adjacency.indices, indptr=adjacency.indptr,
+                             shape=np.array(adjacency.shape), full_nnz=np.array(full_nnz))
+                    os.replace(tmp_file, cache_file)
+                except OSError:
+                    print("\t\tWarning: failed to write metapath cache to", cache_dir)
+        if k > 0:
+            print("\tmetapath {}: {} -> {} edges (top-{} by {})".format(
+                metapath_name(metapath), full_nnz, adjacency.nnz, k, score))
+        else:
+            print("\tmetapath {}: {} edges".format(metapath_name(metapath), full_nnz))
+        adjacencies[metapath] = adjacency
+    return adjacencies
@@ -0,0 +1,67 @@
+import math
+import torch
+
+
+class LazyAdam(torch.optim.Optimizer):
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8):
+        r"""Adam whose ``lazy`` parameter groups are updated row by row.
+
+        In a group created with ``lazy=True`` (embedding tables), only the rows whose gradient is not all zero
+        are touched: their moments and values are gathered, updated with the Adam rule and scattered back,
+        the moments of the other rows are left as they are instead of decaying. The bias correction uses the
+        number of steps of the table, as ``torch.optim.SparseAdam`` does. Other groups follow ``torch.optim.Adam``.
+
+        Args:
+            params (iterable): Parameters or parameter groups, a group may set ``lazy=True``.
+            lr (float): Learning rate.
+            betas (tuple): Decay rates of the first and second moment.
+            eps (float): Term added to the denominator.
+        """
+        defaults = dict(lr=lr, betas=betas, eps=eps, lazy=False)
+        super(LazyAdam, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for param in group['params']:
+                if param.grad is None:
+                    continue
+                grad = param.grad
+                state = self.state[param]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(param)
+                    state['exp_avg_sq'] = torch.zeros_like(param)
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+
+                if group['lazy']:
+                    # 只更新梯度非零的行
+                    rows = torch.nonzero(grad.reshape(len(grad), -1).ne(0).any(dim=1)).squeeze(1)
+                    if len(rows) == 0:
+                        continue
+                    state['step'] += 1
+                    grad = grad.index_select(0, rows)
+                    row_avg = exp_avg.index_select(0, rows).mul_(beta1).add_(grad, alpha=1 - beta1)
+                    row_avg_sq = exp_avg_sq.index_select(0, rows).mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                    exp_avg.index_copy_(0, rows, row_avg)
+                    exp_avg_sq.index_copy_(0, rows, row_avg_sq)
+                else:
+                    state['step'] += 1
+                    row_avg = exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                    row_avg_sq = exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+                bias_correction1 = 1 - beta1 ** state['step']
+                bias_correction2 = 1 - beta2 ** state['step']
+                denom = (row_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(group['eps'])
+                update = row_avg.div(denom).mul_(-group['lr'] / bias_correction1)
+                if group['lazy']:
+                    param.index_add_(0, rows, update)
+                else:
+                    param.add_(update)
+        return loss
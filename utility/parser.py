@@ -19,6 +19,8 @@ def parse_args():
     parser.add_argument('--epochs', type=int, default=1000, help='number of epochs')
     parser.add_argument('--batch_size', type=int, default=2048, help='batch size')
     parser.add_argument('--layer_size', nargs='?', default='[64,64,64]', help='Output sizes of every layer')
+    parser.add_argument('--sample_mode', default='random', choices=['random', 'epoch'],
+                        help="random: draw users uniformly; epoch: visit every training interaction once")
     parser.add_argument('--test_batch_size', type=int, default=100, help='batch size')
     parser.add_argument("--mess_keep_prob", nargs='?', default='[0.1, 0.1, 0.1]', help="ratio of node dropout")
     parser.add_argument("--node_keep_prob", type=float, default=0.1, help="ratio of node dropout")
@@ -29,12 +31,17 @@ def parse_args():
     parser.add_argument('--l2', type=float, default=1e-4, help='l2 regularization weight')
 
     parser.add_argument("--lr", type=float, default=0.0001, help="Learning Rate")
+    parser.add_argument("--lazy_adam", type=int, default=0,
+                        help="update only the embedding-table rows with a non-zero gradient (row-wise lazy Adam)")
 
     parser.add_argument(
         "--num_workers",
         type=int,
-        default=10,
-        help="Number of processes to construct batches",
+        default=1,
+        help="Number of threads prefetching the training samples of upcoming epochs, 0 to sample inline. Every "
+             "worker keeps one epoch of [n_train, 3] int64 triples in flight (about 11 MB on DoubanBook) and "
+             "samples on one CPU core; the workers start before model construction and compete with the "
+             "similarity, k-means and metapath startup work, 1 already prepares epoch N+1 while epoch N trains",
     )
 
     parser.add_argument(
@@ -53,6 +60,54 @@ def parse_args():
     parser.add_argument(
         "--num_heads", default=1, type=int, help="Number of attention heads"
     )
+    parser.add_argument(
+        "--han_fused_spmm",
+        default=1,
+        type=int,
+        help="Aggregate all metapaths of a node type with one SpMM over their stacked normalized adjacency",
+    )
+    parser.add_argument(
+        "--metapath_cache",
+        default=1,
+        type=int,
+        help="Cache the metapath-reachable graphs under <data_path>/<dataset>/metapath.cache/",
+    )
+    parser.add_argument(
+        "--metapath_threads",
+        default=4,
+        type=int,
+        help="Number of threads computing the metapath sparse products",
+    )
+    parser.add_argument(
+        "--metapath_topk",
+        nargs="?",
+        default="0",
+        help="Metapath neighbors kept per node, an int for all metapaths or e.g. \"{'bc-cb': 50, 'bc1-cb1': 50}\"; "
+             "0 keeps the full reachable graph",
+    )
+    parser.add_argument(
+        "--metapath_topk_score",
+        default="count",
+        choices=["count", "random_walk"],
+        help="Ranking of the metapath neighbors kept by --metapath_topk",
+    )
+    parser.add_argument(
+        "--han_fanout",
+        nargs="?",
+        default="0",
+        help="Train the metapath branch on sampled blocks of each batch's receptive field with this many neighbors "
+             "per node, an int for all metapaths or e.g. \"{'ub-bu': 10, 'bc-cb': 5}\" (missing ones keep all "
+             "neighbors); 0 runs it on the full graph. Requires --car_mode batch or sample, with 'full' every node "
+             "would be a seed of every step",
+    )
+    parser.add_argument(
+        "--han_attention_interval",
+        type=int,
+        default=50,
+        help="With --han_fanout, recompute the metapath attention scores over all nodes on the full graph every "
+             "this many steps (1 makes a fanout of 0 match full-graph training); 0 averages them over the batch "
+             "seeds only, which biases the metapath weights towards the sampled nodes",
+    )
 
     parser.add_argument(
         "--gpu",
@@ -71,11 +126,40 @@ def parse_args():
 
     parser.add_argument('--GCNLayer', type=int, default=3, help="the layer number of GCN")
     parser.add_argument('--n_layers', type=int, default=1, help="the layer number of GCN")
+    parser.add_argument('--han_layers', type=int, default=1, help="the number of stacked metapath (HAN) layers")
+    parser.add_argument('--checkpointing', type=int, default=0,
+                        help="recompute the metapath convolutions and semantic attention during backward instead "
+                             "of storing their activations; LightGCN layers save nothing for backward, so they "
+                             "just stop keeping every layer's output")
+    parser.add_argument('--adj_norm', default='sym', choices=['sym', 'left', 'right'],
+                        help="normalization of the user-item adjacency: D^-1/2 A D^-1/2, D^-1 A or A D^-1")
+    parser.add_argument('--fused_propagation', type=int, default=1,
+                        help="propagate the base and both perturbed views with one SpMM over [N, 3D] per layer")
+    parser.add_argument('--self_loop', type=int, default=0, help="add self-loops before normalizing the adjacency")
+    parser.add_argument('--partitions', type=int, default=0,
+                        help="Cluster-GCN style training: number of graph partitions, 0 trains on the full graph. The "
+                             "triples of every group of --partitions_per_batch partitions are split into "
+                             "--batch_size steps that share one step adjacency; --car_mode batch is not supported")
+    parser.add_argument('--partitions_per_batch', type=int, default=4,
+                        help="partitions whose triples form one group of training steps when --partitions > 0")
+    parser.add_argument('--partition_positives', default='neighbors', choices=['neighbors', 'intra'],
+                        help="positive items outside the partitions of a group: 'neighbors' adds their full "
+                             "neighborhood to the step adjacency so they aggregate as exactly as the negatives, "
+                             "'intra' drops their triples as Cluster-GCN drops the links between clusters")
+    parser.add_argument('--partition_iters', type=int, default=10, help="label propagation sweeps of the partitioner")
+    parser.add_argument('--history_interval', type=int, default=0,
+                        help="reuse the propagated tables (historical embeddings) for this many training steps before "
+                             "re-propagating, -1 refreshes once per epoch, 0 propagates every step; between refreshes the batch "
+                             "rows are recomputed from cached neighbour values so gradients still reach their neighbours")
 
     # Contrast learing
     parser.add_argument(
         "--cl_rate", default=0.01, type=float, help="the proportion of cl_loss."
     )
+    parser.add_argument("--ssl_chunk_size", default=1024, type=int,
+                        help="anchors per block when streaming the InfoNCE / uniformity log-sum-exp, bounds peak memory")
+    parser.add_argument("--ssl_queue_size", default=0, type=int,
+                        help="size of the queue of recent view-2 embeddings used as extra negatives, 0 disables")
     parser.add_argument("--temperature", default=0.6, type=float, help=".")
     parser.add_argument("--lam", default=0.5, type=float, help=".")
     parser.add_argument("--cl_hidden_dim", default=128, type=int, help=".")
@@ -87,6 +171,9 @@ def parse_args():
 
     # align and uniform
     parser.add_argument("--gamma", default=1.0, type=float, help="self.gamma * (self.uniformity(user_e) + self.uniformity(item_e)) / 2.")
+    parser.add_argument("--uniformity", default='exact', choices=['pdist', 'exact', 'sampled'],
+                        help="uniformity estimator: torch.pdist, blockwise exact log-mean-exp or random pairs")
+    parser.add_argument("--uniformity_pairs", default=4096, type=int, help="random pairs used by --uniformity sampled")
     parser.add_argument("--beta", default=1, type=float, help=".")
 
     # Regularization
@@ -98,7 +185,22 @@ def parse_args():
     parser.add_argument('--cluster_level', type=int, default=2, help='cluster_level')
     parser.add_argument('--lambda_H', type=float, default=0.002, help='lambda_H')
     parser.add_argument('--lambda_T', type=float, default=2.0, help='lambda_T')
+    parser.add_argument('--kmeans_iters', type=int, default=100, help='mini-batch k-means updates per level')
+    parser.add_argument('--kmeans_sample_size', type=int, default=4096, help='points sampled per k-means update')
+    parser.add_argument('--recluster_interval', type=int, default=0,
+                        help='re-cluster the fused embeddings in the background every N training steps, 0 disables')
+    parser.add_argument('--recluster_iters', type=int, default=20, help='mini-batch k-means updates per re-clustering')
+    parser.add_argument('--recluster_sample_size', type=int, default=4096,
+                        help='points sampled per k-means update when re-clustering')
+    parser.add_argument('--similarity_workers', type=int, default=1,
+                        help='processes computing the user and item kNN similarity blocks, 1 computes inline '
+                             '(spawning workers only pays off on large interaction matrices)')
     parser.add_argument('--head_persent', type=int, default=85, help='head_persent')
+    parser.add_argument('--car_mode', default='full', choices=['full', 'batch', 'sample'],
+                        help='nodes used by CAR: all head/tail nodes, only the batch nodes, or a random subsample')
+    parser.add_argument('--car_sample_size', type=int, default=4096,
+                        help='head/tail nodes drawn per step in sample mode, and nodes without training interactions '
+                             'drawn per step in batch mode')
 
     return parser.parse_args()
 
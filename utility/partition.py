@@ -0,0 +1,112 @@
+import numpy as np
+
+
+def label_propagation_partition(adj, num_parts, num_users, max_iter=10, imbalance=1.1, seed=2023):
+    r"""Balanced partition of the user-item graph by size-capped label propagation.
+
+    Labels start as a balanced random assignment. Every sweep moves each node to the label most frequent
+    among its neighbors when that strictly increases its intra-partition edges, and a label accepts at most
+    ``ceil(N / num_parts * imbalance)`` members, the moves with the largest gain first. Users and items are
+    updated in alternating half-sweeps, the synchronous update would oscillate on a bipartite graph.
+
+    Args:
+        adj (scipy.sparse.csr_matrix): [N, N] symmetric adjacency, users first.
+        num_parts (int): Number of partitions.
+        num_users (int): Number of user nodes, the rows ``num_users:`` are items.
+        max_iter (int): Maximum number of sweeps, stops earlier once no node moves.
+        imbalance (float): Allowed ratio of the largest partition to the average size.
+        seed (int): Seed of the random initialization and tie breaking.
+
+    Returns:
+        numpy.ndarray: [N] int64 partition id of every node.
+    """
+    adj = adj.tocsr()
+    n = adj.shape[0]
+    rng = np.random.default_rng(seed)
+    rows = np.repeat(np.arange(n, dtype=np.int64), np.diff(adj.indptr))
+    cols = adj.indices.astype(np.int64)
+    capacity = int(np.ceil(n / num_parts * imbalance))
+    labels = rng.permutation(n) % num_parts
+
+    for _ in range(max_iter):
+        moved = 0
+        for start, end in ((0, num_users), (num_users, n)):
+            edges = slice(adj.indptr[start], adj.indptr[end])
+            keys, counts = np.unique(rows[edges] * num_parts + labels[cols[edges]], return_counts=True)
+            if len(keys) == 0:
+                continue
+            nodes, node_labels = keys // num_parts, keys % num_parts
+            # 每个节点邻居中最多的标签, 并列时随机选择
+            order = np.lexsort((rng.random(len(keys)), -counts, nodes))
+            first = order[np.r_[True, nodes[order][1:] != nodes[order][:-1]]]
+            best_nodes, best_labels, best_counts = nodes[first], node_labels[first], counts[first]
+            current_keys = best_nodes * num_parts + labels[best_nodes]
+            pos = np.minimum(np.searchsorted(keys, current_keys), len(keys) - 1)
+            current_counts = np.where(keys[pos] == current_keys, counts[pos], 0)
+            gain = best_counts - current_counts
+            want = gain > 0
+            movers, targets, gain = best_nodes[want], best_labels[want], gain[want]
+
+            # 按收益从大到小接收, 每个标签不超过剩余容量
+            order = np.lexsort((-gain, targets))
+            movers, targets = movers[order], targets[order]
+            target_counts = np.bincount(targets, minlength=num_parts)
+            rank = np.arange(len(targets)) - np.repeat(np.cumsum(target_counts) - target_counts, target_counts)
+            room = capacity - np.bincount(labels, minlength=num_parts)
+            accept = rank < room[targets]
+            labels[movers[accept]] = targets[accept]
+            moved += int(accept.sum())
+        if moved == 0:
+            break
+
+    intra = np.mean(labels[rows] == labels[cols]) if len(rows) > 0 else 1.
+    sizes = np.bincount(labels, minlength=num_parts)
+    print("\tpartitioned {} nodes into {} parts (max size {}), intra-partition edges: {:.2%}".format(
+        n, num_parts, sizes.max(), intra))
+    return labels.astype(np.int64)
+
+
+def partition_batches(sample_data, node_parts, num_users, parts_per_batch, sampler=None, rng=None,
+                      intra_only=False):
+    r"""Groups the triples of an epoch into Cluster-GCN steps.
+
+    The partitions are visited in a random order, ``parts_per_batch`` at a time; a group holds the triples
+    whose user lies in those partitions. With ``sampler`` the negatives are re-drawn among the items of the
+    same partitions, whose propagated embeddings are exact within the step. The positive item of a triple
+    may lie in another partition; ``intra_only`` drops those triples, as Cluster-GCN drops the links between
+    clusters, otherwise the caller has to give the positives their full neighborhood.
+
+    Args:
+        sample_data (numpy.ndarray): [n, 3] (user, positive item, negative item) triples.
+        node_parts (numpy.ndarray): [N] partition id of every node, users first.
+        num_users (int): Number of user nodes.
+        parts_per_batch (int): Number of partitions per step.
+        sampler (NegativeSampler): Re-draws the negatives if given.
+        intra_only (bool): Keep only the triples whose positive item lies in the partitions of the group.
+        rng (numpy.random.Generator or numpy.random.RandomState): Source of randomness, the global numpy
+            state is used if None.
+
+    Yields:
+        (numpy.ndarray, numpy.ndarray): Partition ids of the step and its [m, 3] triples.
+    """
+    rng = np.random.mtrand._rand if rng is None else rng
+    num_parts = int(node_parts.max()) + 1
+    user_parts = node_parts[sample_data[:, 0]]
+    order = np.argsort(user_parts, kind='stable')
+    ptr = np.r_[0, np.cumsum(np.bincount(user_parts, minlength=num_parts))]
+    item_parts = node_parts[num_users:]
+    permutation = rng.permutation(num_parts)
+    for start in range(0, num_parts, parts_per_batch):
+        parts = permutation[start:start + parts_per_batch]
+        index = np.concatenate([order[ptr[part]:ptr[part + 1]] for part in parts])
+        if len(index) == 0:
+            continue
+        triples = sample_data[index]
+        if intra_only:
+            triples = triples[np.isin(item_parts[triples[:, 1]], parts)]
+            if len(triples) == 0:
+                continue
+        if sampler is not None:
+            triples[:, 2] = sampler.sample_negative(triples[:, 0], rng,
+                                                    candidates=np.flatnonzero(np.isin(item_parts, parts)))
+        yield parts, triples
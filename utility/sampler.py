@@ -0,0 +1,140 @@
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class NegativeSampler(object):
+    def __init__(self, user_item_net):
+        r"""Batched (user, pos, neg) sampler over the training interactions.
+
+        The positives are kept as a sorted CSR; membership of a candidate
+        negative is tested with ``np.searchsorted`` over the flattened pair keys
+        ``user * num_items + item``, which are globally sorted in CSR order.
+
+        Args:
+            user_item_net (scipy.sparse.csr_matrix): The [num_users, num_items] training interaction matrix.
+        """
+        net = user_item_net.tocsr(copy=True)
+        net.sum_duplicates()
+        net.sort_indices()
+        self.num_users, self.num_items = net.shape
+        self.indptr = net.indptr.astype(np.int64)
+        self.indices = net.indices.astype(np.int64)
+        self.degree = np.diff(self.indptr)
+        self.num_train = len(self.indices)
+        # 用户 id 按行展开，与 indices 一一对应
+        self.rows = np.repeat(np.arange(self.num_users, dtype=np.int64), self.degree)
+        self.pair_keys = self.rows * self.num_items + self.indices
+
+    def contains(self, users, items):
+        """Vectorized test of whether each (users[i], items[i]) is a training interaction."""
+        keys = users * self.num_items + items
+        pos = np.searchsorted(self.pair_keys, keys)
+        found = pos < len(self.pair_keys)
+        found[found] = self.pair_keys[pos[found]] == keys[found]
+        return found
+
+    def sample_negative(self, users, rng=None, candidates=None, max_rounds=10):
+        """
+        Draws one negative item per user, re-drawing only the rejected slots.
+        With ``candidates`` the negatives come from that item subset, slots still rejected after
+        ``max_rounds`` draws fall back to all items.
+        """
+        rng = np.random.mtrand._rand if rng is None else rng
+        pool = None if candidates is None or len(candidates) == 0 else np.asarray(candidates, dtype=np.int64)
+
+        def draw(size):
+            if pool is None:
+                return (rng.random(size) * self.num_items).astype(np.int64)
+            return pool[(rng.random(size) * len(pool)).astype(np.int64)]
+
+        negatives = draw(len(users))
+        rejected = np.flatnonzero(self.contains(users, negatives))
+        rounds = 0
+        while len(rejected) > 0:
+            rounds += 1
+            if rounds > max_rounds:
+                pool = None
+            negatives[rejected] = draw(len(rejected))
+            rejected = rejected[self.contains(users[rejected], negatives[rejected])]
+        return negatives
+
+    def sample(self, mode='random', rng=None):
+        r"""Draws the triples of a whole epoch at once.
+
+        Args:
+            mode (str): 'random' draws ``num_train`` users uniformly and one positive per user, as the
+                original per-sample loop did (users without positives are dropped). 'epoch' visits every
+                training interaction exactly once in a random order.
+            rng (numpy.random.Generator or numpy.random.RandomState): Source of randomness, the global
+                numpy state is used if None.
+
+        Returns:
+            numpy.ndarray: int64 array of shape [n, 3] holding (user, positive item, negative item).
+        """
+        rng = np.random.mtrand._rand if rng is None else rng
+        if mode == 'random':
+            users = (rng.random(self.num_train) * self.num_users).astype(np.int64)
+            users = users[self.degree[users] > 0]
+            offsets = (rng.random(len(users)) * self.degree[users]).astype(np.int64)
+            positives = self.indices[self.indptr[users] + offsets]
+        elif mode == 'epoch':
+            order = rng.permutation(self.num_train)
+            users = self.rows[order]
+            positives = self.indices[order]
+        else:
+            raise NotImplementedError("Make sure 'mode' in ['random', 'epoch']!")
+        negatives = self.sample_negative(users, rng)
+        return np.stack([users, positives, negatives], axis=1)
+
+
+class SamplePrefetcher(object):
+    def __init__(self, dataset, mode='random', num_workers=1, seed=2023):
+        r"""Generates the training triples of upcoming epochs in background threads.
+
+        Worker ``w`` owns the RNG stream ``SeedSequence(seed).spawn(num_workers)[w]`` and produces epochs
+        ``w, w + num_workers, ...``, so the sequence of epochs only depends on ``seed`` and ``num_workers``.
+        The triples come back already in random order, no extra shuffle is required.
+
+        Args:
+            dataset (Data): The dataset whose ``sample_data_to_train_all`` is called.
+            mode (str): Sampling mode forwarded to ``sample_data_to_train_all``.
+            num_workers (int): Number of sampling threads and epochs kept in flight, 0 samples synchronously.
+            seed (int): Root seed of the per-worker RNG streams.
+        """
+        self.dataset = dataset
+        self.mode = mode
+        self.num_workers = max(num_workers, 0)
+        streams = np.random.SeedSequence(seed).spawn(max(self.num_workers, 1))
+        self.rngs = [np.random.default_rng(stream) for stream in streams]
+        self.executor = ThreadPoolExecutor(self.num_workers) if self.num_workers > 0 else None
+        self.pending = deque()
+        self.epoch = 0
+        for _ in range(self.num_workers):
+            self._submit()
+
+    def _sample(self, epoch):
+        return self.dataset.sample_data_to_train_all(self.mode, self.rngs[epoch % len(self.rngs)])
+
+    def _submit(self):
+        self.pending.append(self.executor.submit(self._sample, self.epoch))
+        self.epoch += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.executor is None:
+            self.epoch += 1
+            return self._sample(self.epoch - 1)
+        sample_data = self.pending.popleft().result()
+        self._submit()
+        return sample_data
+
+    def close(self):
+        if self.executor is not None:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+            self.executor = None
+            self.pending.clear()
@@ -0,0 +1,130 @@
+import numpy as np
+import scipy.sparse as sp
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# 子进程中的全局矩阵, 由 _init_worker 设置一次, 避免每个任务重复序列化
+_MATRICES = {}
+
+
+def _init_worker(matrices):
+    _MATRICES.update(matrices)
+
+
+def row_norms(matrix):
+    return np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1), dtype=np.float32).ravel())
+
+
+def topk_similarity_block(matrix, matrix_t, norms, start, end, topk, shrink=0., normalize=True):
+    r"""Top-k cosine neighbors of rows ``start:end`` of ``matrix`` against all of its rows.
+
+    The block product ``matrix[start:end] @ matrix.T`` stays sparse. A few hundred of its rows at a time are
+    densified when the product is dense anyway, or scattered into a score array padded to the longest row
+    otherwise, and ``np.argpartition`` picks the top-k of every row; only the k picked entries are sorted.
+
+    Args:
+        matrix (scipy.sparse.csr_matrix): [n, m] rows to compare.
+        matrix_t (scipy.sparse.csr_matrix): ``matrix.T`` in CSR form.
+        norms (numpy.ndarray): L2 norm of every row of ``matrix``.
+        topk (int): Number of neighbors kept per row.
+        shrink (float): hyper-parameter in calculate cosine distance.
+        normalize (bool): If True divide the dot product by the product of the norms.
+
+    Returns:
+        numpy.ndarray: [end - start, topk] int32 neighbor ids sorted by similarity, padded with -1.
+        numpy.ndarray: [end - start, topk] float32 similarities, padded with 0.
+    """
+    block = (matrix[start:end] @ matrix_t).tocsr()
+    block.data = block.data.astype(np.float32)
+    neighbors = np.full((end - start, topk), -1, dtype=np.int32)
+    weights = np.zeros((end - start, topk), dtype=np.float32)
+    counts = np.diff(block.indptr)
+    width = int(counts.max()) if len(counts) > 0 else 0
+    if width == 0:
+        return neighbors, weights
+    # 乘积足够稠密时直接转为稠密行, 否则按最长的行填充
+    dense = 2 * width > block.shape[1]
+    negative = bool(block.data.min() < 0) or (not normalize and shrink < 0)
+    if not dense:
+        rows = np.repeat(np.arange(end - start), counts)
+        rank = np.arange(len(rows)) - np.repeat(block.indptr[:-1], counts)
+
+    # 分段处理, 每段的得分数组约 4M 个元素
+    step = max(1, (1 << 22) // (block.shape[1] if dense else width))
+    for first in range(0, end - start, step):
+        last = min(first + step, end - start)
+        if dense:
+            scores = block[first:last].toarray()
+            scores[np.arange(last - first), np.arange(start + first, start + last)] = 0.0  # 设置自身相似度为0
+            if normalize:
+                scores /= norms[start + first:start + last, None] * norms + shrink + 1e-6
+        else:
+            edges = slice(block.indptr[first], block.indptr[last])
+            ids = np.zeros((last - first, width), dtype=np.int32)
+            ids[rows[edges] - first, rank[edges]] = block.indices[edges]
+            values = block.data[edges]
+            values[ids[rows[edges] - first, rank[edges]] == rows[edges] + start] = 0.0  # 设置自身相似度为0
+            if normalize:
+                values = values / (norms[rows[edges] + start] * norms[block.indices[edges]] + shrink + 1e-6)
+            scores = np.zeros((last - first, width), dtype=np.float32)
+            scores[rows[edges] - first, rank[edges]] = values
+        if not normalize and shrink != 0:
+            scores /= shrink
+        if negative:
+            scores[scores == 0.0] = -np.inf  # 相似度为 0 的 (含填充) 不算邻居, 非负时 0 本来就排在最后
+
+        k = min(topk, scores.shape[1])
+        if k < scores.shape[1]:
+            picked = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores = np.take_along_axis(scores, picked, axis=1)
+        else:
+            picked = np.broadcast_to(np.arange(k), scores.shape)
+        picked = picked if dense else np.take_along_axis(ids, picked, axis=1)
+        # 只对选出的 k 个排序, 相同得分按编号
+        order = np.lexsort((picked, -scores))
+        scores, picked = np.take_along_axis(scores, order, axis=1), np.take_along_axis(picked, order, axis=1)
+        found = np.isfinite(scores) & (scores != 0.0)
+        neighbors[first:last, :k] = np.where(found, picked, -1)
+        weights[first:last, :k] = np.where(found, scores, 0.)
+    return neighbors, weights
+
+
+def _run_block(name, start, end, topk, shrink, normalize):
+    matrix, matrix_t, norms = _MATRICES[name]
+    return topk_similarity_block(matrix, matrix_t, norms, start, end, topk, shrink, normalize)
+
+
+def topk_similarity(matrices, topk, shrink=0., normalize=True, block_size=1000, n_jobs=1):
+    r"""Top-k cosine neighbors for several matrices, with the row blocks of all of them run in a process pool.
+
+    Args:
+        matrices (dict): name -> scipy.sparse matrix whose rows are compared.
+        n_jobs (int): Number of worker processes, 1 computes in the current process.
+
+    Returns:
+        dict: name -> (neighbors, weights) padded arrays of shape [n_rows, topk].
+    """
+    prepared = {}
+    for name, matrix in matrices.items():
+        matrix = matrix.tocsr().astype(np.float32)
+        prepared[name] = (matrix, matrix.T.tocsr(), row_norms(matrix))
+    tasks = [(name, start, min(start + block_size, value[0].shape[0]))
+             for name, value in prepared.items() for start in range(0, value[0].shape[0], block_size)]
+
+    if n_jobs > 1 and len(tasks) > 1:
+        # spawn: 父进程可能已有运行中的线程 (样本预取), fork 不安全
+        with ProcessPoolExecutor(min(n_jobs, len(tasks)), mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(prepared,)) as pool:
+            futures = [pool.submit(_run_block, name, start, end, topk, shrink, normalize)
+                       for name, start, end in tasks]
+            results = [future.result() for future in futures]
+    else:
+        _init_worker(prepared)
+        results = [_run_block(name, start, end, topk, shrink, normalize) for name, start, end in tasks]
+        _MATRICES.clear()
+
+    output = {}
+    for name in prepared:
+        blocks = [result for (task_name, _, _), result in zip(tasks, results) if task_name == name]
+        output[name] = (np.concatenate([b[0] for b in blocks]), np.concatenate([b[1] for b in blocks]))
+    return output